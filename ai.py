@@ -1,15 +1,59 @@
+import asyncio
+import functools
+import logging
+from typing import Callable
+
 from langchain_community.chat_models import GigaChat
 from langchain_core.messages import SystemMessage, HumanMessage
 
-from tokens import gigachat_token
+from game_content import parse_stops, parse_questions, format_stops, format_questions
+from metrics import timed, span
+from tokens import gigachat_token, gigachat_concurrency, gigachat_timeout, gigachat_candidates
 
 giga = GigaChat(credentials=gigachat_token,
                 model='GigaChat:latest',
                 verify_ssl_certs=False
                 )
 
+# сколько запросов к GigaChat идёт одновременно на весь бот; остальные ждут своей очереди
+gigachat_semaphore = asyncio.Semaphore(gigachat_concurrency)
+
+
+# версии промптов: сохранённые ответы старой версии больше не показываются
+PROMPT_VERSIONS = {"stops": 1, "questions": 1}
+
+
+# асинхронный вызов модели: бот продолжает обслуживать других пользователей, пока GigaChat думает;
+# если модель не ответила за gigachat_timeout секунд, бросает TimeoutError; возвращает ответ и потраченные токены.
+# С on_chunk ответ читается потоком, и on_chunk получает весь накопленный текст после каждого куска;
+# в потоке GigaChat не сообщает расход токенов, поэтому тогда их 0
+async def ask_gigachat(system_message: SystemMessage, title: str, description: str,
+                       on_chunk: Callable[[str], None] | None = None) -> tuple[str, int]:
+    messages = [system_message, HumanMessage(f"Название: {title}, описание: {description}")]
+    async with gigachat_semaphore:
+        # отдельно от get_*_from_gigachat, куда входит и ожидание семафора
+        with span("ai.gigachat"):
+            async with asyncio.timeout(gigachat_timeout):
+                if on_chunk is None:
+                    response = await giga.ainvoke(messages)
+                    content = response.content
+                    token_usage = response.response_metadata.get("token_usage")
+                    tokens = token_usage.total_tokens if token_usage is not None else 0
+                else:
+                    content = ""
+                    async for chunk in giga.astream(messages):
+                        if chunk.content:
+                            content += chunk.content
+                            on_chunk(content)
+                    tokens = 0
 
-def get_questions_from_gigachat(title: str, description: str):
+    logging.info(content)
+    return content, tokens
+
+
+@timed()
+async def get_questions_from_gigachat(title: str, description: str,
+                                      on_chunk: Callable[[str], None] | None = None) -> tuple[str, int]:
     system_message = SystemMessage(content='Когда пользователь отправит тебе название и описание мероприятия, '
                                            'ты должен будешь составить 5 контрольных вопросов. '
                                            'Формат каждого контрольного вопроса: '
@@ -19,15 +63,11 @@ def get_questions_from_gigachat(title: str, description: str):
                                            'Учти, что эти вопросы будут задаваться после прохождения '
                                            'мероприятия. Будь креативным.')
 
-    response = giga([
-        system_message,
-        HumanMessage(f"Название: {title}, описание: {description}")
-    ])
+    return await ask_gigachat(system_message, title, description, on_chunk)
 
-    print(response.content)
-    return response.content
-
-def get_stops_from_gigachat(title: str, description: str):
+@timed()
+async def get_stops_from_gigachat(title: str, description: str,
+                                  on_chunk: Callable[[str], None] | None = None) -> tuple[str, int]:
     system_message = SystemMessage(content='Когда пользователь отправит тебе название и описание мероприятия, '
                                            'ты должен будешь составить 5 контрольных точек этого мероприятия. '
                                            'Это может быть поговорить с каким-либо экспертом либо что-то подобное. '
@@ -36,10 +76,77 @@ def get_stops_from_gigachat(title: str, description: str):
                                            'Каждая контрольная точка - с новой строки.'
                                            'Будь креативным. Нумеруй контрольные точки.')
 
-    response = giga([
-        system_message,
-        HumanMessage(f"Название: {title}, описание: {description}")
-    ])
+    return await ask_gigachat(system_message, title, description, on_chunk)
+
+
+# ответ GigaChat в том виде, в каком его показать организатору, или None, если формат не тот
+def normalize_stops(gigachat_answer: str) -> str | None:
+    stops = parse_stops(gigachat_answer, expected=5)
+    return format_stops(stops) if stops is not None else None
+
+
+def normalize_questions(gigachat_answer: str) -> str | None:
+    questions = parse_questions(gigachat_answer, expected=5)
+    return format_questions(questions) if questions is not None else None
+
+
+GENERATORS = {
+    "stops": (get_stops_from_gigachat, normalize_stops),
+    "questions": (get_questions_from_gigachat, normalize_questions),
+}
+
+
+# в каждом из rounds раундов параллельно запрашивает candidates вариантов и берёт первый подходящий,
+# отменяя остальные: организатор ждёт примерно один ответ модели, а не три подряд;
+# возвращает ответ (или None) и токены всех дождавшихся ответов. Упавший запрос (таймаут, 5xx, обрыв соединения)
+# считается неподходящим ответом и не мешает остальным; если не ответил ни один запрос, бросает последнюю ошибку.
+# С on_progress варианты читаются потоком, и on_progress получает текст одного из них - того, что начал отвечать первым;
+# если он оказался неподходящим, показывается следующий
+async def generate_suggestion(kind: str, title: str, description: str, candidates: int = gigachat_candidates,
+                              rounds: int = 1,
+                              on_progress: Callable[[str], None] | None = None) -> tuple[str | None, int]:
+    get_from_gigachat, normalize = GENERATORS[kind]
+    tokens = 0
+    answered = False
+    error: Exception | None = None
+    # номер варианта, который сейчас показывается
+    shown = None
+
+    def on_chunk(candidate: int, text: str):
+        nonlocal shown
+        if shown is None:
+            shown = candidate
+        if shown == candidate:
+            on_progress(text)
 
-    print(response.content)
-    return response.content
\ No newline at end of file
+    for _ in range(rounds):
+        tasks = {asyncio.create_task(get_from_gigachat(
+                     title, description, functools.partial(on_chunk, candidate) if on_progress else None)): candidate
+                 for candidate in range(candidates)}
+        try:
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if shown == tasks[task]:
+                        shown = None
+                    try:
+                        gigachat_answer, answer_tokens = task.result()
+                    except TimeoutError as e:
+                        error = e
+                        continue
+                    except Exception as e:
+                        logging.warning(f"Запрос к GigaChat ({kind}) не удался: {e!r}")
+                        error = e
+                        continue
+                    answered = True
+                    tokens += answer_tokens
+                    suggestion = normalize(gigachat_answer)
+                    if suggestion is not None:
+                        return suggestion, tokens
+        finally:
+            for task in tasks:
+                task.cancel()
+    if not answered:
+        raise error
+    return None, tokens
@@ -0,0 +1,40 @@
+# python -m benchmarks.date_parsing
+import timeit
+
+import dateparser
+
+from misc import parse_event_date, _parse_event_date
+
+# одна страница анонсов EXTRA.HSE - около двадцати дат
+PAGE = ["17 января", "18 января", "пятница, 19 января", "20–22 января", "23 января 2025", "24 января",
+        "25 января – 2 февраля", "26 января", "27 января", "28 января", "29 января", "30 января", "31 января",
+        "1 февраля", "2 февраля", "3 февраля", "вторник, 4 февраля", "5 февраля", "6 февраля", "7 февраля"]
+
+
+def parse_page_with_dateparser():
+    for event_date_text in PAGE:
+        dateparser.parse(event_date_text.split(",")[0] if event_date_text[0].isalpha() else event_date_text)
+
+
+def parse_page_cold():
+    _parse_event_date.cache_clear()
+    for event_date_text in PAGE:
+        parse_event_date(event_date_text)
+
+
+def parse_page_warm():
+    for event_date_text in PAGE:
+        parse_event_date(event_date_text)
+
+
+def main():
+    parse_page_with_dateparser()
+    for name, fn, number in [("dateparser", parse_page_with_dateparser, 20),
+                             ("регулярка, пустой кэш", parse_page_cold, 2000),
+                             ("регулярка, тёплый кэш", parse_page_warm, 20000)]:
+        seconds = min(timeit.repeat(fn, number=number, repeat=5)) / number
+        print(f"{name:>24}: {seconds * 1e6:10.1f} мкс на страницу")
+
+
+if __name__ == "__main__":
+    main()
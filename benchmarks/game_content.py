@@ -0,0 +1,119 @@
+# python -m benchmarks.game_content
+#
+# Сколько стоит одно нажатие в вопросах игры: как раньше (вся строка, json и сборка клавиатуры из CallbackData)
+# и как сейчас (только нужные столбцы, orjson, собранный заранее EventGameContent). База - временный файл, db.db не трогается.
+import asyncio
+import datetime
+import json
+import os
+import random
+import tempfile
+import time
+
+from sqlalchemy import select, type_coerce, String
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from aiogram.utils.keyboard import InlineKeyboardBuilder
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+from sqlalchemy.orm import undefer
+
+from classes import EventGameQuestionCallback
+
+from db import Base, DBEventGame, db_get_event_game_content
+from game_content import EventGameContent
+
+EVENT_ID = "900100000"
+STOPS = [f"Контрольная точка {i}: подойдите к стенду №{i} и найдите на нём QR-код с кодовым словом." * 2
+         for i in range(1, 11)]
+QUESTIONS = [[f"Контрольный вопрос {i}: что рассказывали на лекции о теме №{i}?",
+              f"Правильный ответ {i}", f"Неправильный ответ {i}", f"Ещё один неправильный ответ {i}"]
+             for i in range(1, 11)]
+
+
+# то, что делал обработчик до изменений: session.get(DBEventGame) со всеми столбцами, json.loads
+# и три EventGameQuestionCallback на каждый вопрос
+async def click_before(session: AsyncSession, event_id: str, points: int = 0):
+    columns = DBEventGame.__table__.c
+    row = (await session.execute(
+        select(columns.event_id, columns.event_title, type_coerce(columns.stops, String).label("stops"),
+               type_coerce(columns.questions, String).label("questions"), columns.start, columns.end)
+        .where(columns.event_id == event_id))).first()
+    question = json.loads(row.questions)[0]
+    json.loads(row.stops)
+    inline_keyboard_builder = InlineKeyboardBuilder()
+    buttons = [InlineKeyboardButton(text=question[answer_index], callback_data=EventGameQuestionCallback(
+        event_id=event_id, question_index=1, last_answer_was_right=answer_index == 1,
+        points=points + 1 if answer_index == 1 else points).pack()) for answer_index in range(1, 3 + 1)]
+    random.shuffle(buttons)
+    for button in buttons:
+        inline_keyboard_builder.add(button)
+    inline_keyboard_builder.adjust(1, 1, 1)
+    return inline_keyboard_builder.as_markup()
+
+
+# первое нажатие после перезапуска: контент читается из базы и собирается
+async def click_cold(session: AsyncSession, event_id: str, points: int = 0):
+    content = EventGameContent(event_id, *await db_get_event_game_content(session, event_id))
+    return click_warm(content, points)
+
+
+def click_warm(content: EventGameContent, points: int = 0):
+    buttons = content.question_buttons(0, points)
+    random.shuffle(buttons)
+    return InlineKeyboardMarkup(inline_keyboard=[[button] for button in buttons])
+
+
+async def measure(session: AsyncSession, fn, iterations: int) -> float:
+    await fn(session, EVENT_ID)
+    started = time.perf_counter()
+    for _ in range(iterations):
+        await fn(session, EVENT_ID)
+    return (time.perf_counter() - started) / iterations
+
+
+async def run(iterations: int):
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_async_engine(f"sqlite+aiosqlite:///{os.path.join(directory, 'bench.db')}")
+        session_maker = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        async with session_maker() as session:
+            db_event_game = DBEventGame()
+            db_event_game.event_id = EVENT_ID
+            db_event_game.event_title = "Тестовое мероприятие"
+            db_event_game.stops = STOPS
+            db_event_game.questions = QUESTIONS
+            db_event_game.start = datetime.datetime(2025, 1, 17, 18)
+            db_event_game.end = datetime.datetime(2025, 1, 17, 21)
+            session.add(db_event_game)
+            await session.commit()
+
+            for name, fn in [("до: строка + json + CallbackData", click_before),
+                             ("после: первое нажатие", click_cold)]:
+                seconds = await measure(session, fn, iterations)
+                print(f"{name:>32}: {seconds * 1e6:10.1f} мкс на нажатие")
+
+            content = EventGameContent(EVENT_ID, *await db_get_event_game_content(session, EVENT_ID))
+            started = time.perf_counter()
+            for _ in range(iterations):
+                click_warm(content)
+            print(f"{'после: EventGameContent в памяти':>32}: "
+                  f"{(time.perf_counter() - started) / iterations * 1e6:10.1f} мкс на нажатие")
+
+            # списки игр больше не тянут тяжёлые столбцы
+            for name, statement in [("список, с контентом", select(DBEventGame).options(
+                                        undefer(DBEventGame.stops), undefer(DBEventGame.questions))),
+                                    ("список, без контента", select(DBEventGame))]:
+                started = time.perf_counter()
+                for _ in range(iterations):
+                    (await session.execute(statement)).scalars().all()
+                    session.expunge_all()
+                print(f"{name:>32}: {(time.perf_counter() - started) / iterations * 1e6:10.1f} мкс на запрос")
+        await engine.dispose()
+
+
+def main():
+    asyncio.run(run(iterations=2000))
+
+
+if __name__ == "__main__":
+    main()
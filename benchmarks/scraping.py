@@ -0,0 +1,195 @@
+# python -m benchmarks.scraping [--engines http selenium] [--output results.json] [--baseline old.json]
+#
+# Поднимает локальный сервер с записанными страницами EXTRA.HSE и меряет движки скрапинга без обращения к сайту.
+import argparse
+import asyncio
+import datetime
+import hashlib
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from aiohttp import web
+
+from browser import SeleniumEngine, DriverPool
+from http_scraper import HttpEngine
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), "fixtures")
+FIRST_EVENT_ID = "900100000"
+
+
+def read_fixture(name: str) -> bytes:
+    with open(os.path.join(FIXTURES_DIR, name), "rb") as fixture:
+        return fixture.read()
+
+
+def fixture_app(latency: float) -> web.Application:
+    fixtures = {name: read_fixture(name) for name in os.listdir(FIXTURES_DIR)}
+
+    async def respond(request: web.Request, name: str, content_type: str) -> web.Response:
+        if latency:
+            await asyncio.sleep(latency)
+        body = fixtures[name]
+        etag = f'"{hashlib.md5(body).hexdigest()}"'
+        if request.headers.get("If-None-Match") == etag:
+            return web.Response(status=304, headers={"ETag": etag})
+        return web.Response(body=body, content_type=content_type, charset="utf-8", headers={"ETag": etag})
+
+    async def announcements(request: web.Request) -> web.Response:
+        return await respond(request, "announcements.html", "text/html")
+
+    async def announcements_page(request: web.Request) -> web.Response:
+        name = f"announcements_page{request.match_info['page']}.html"
+        if name not in fixtures:
+            raise web.HTTPNotFound()
+        return await respond(request, name, "text/html")
+
+    async def event(request: web.Request) -> web.Response:
+        return await respond(request, "event.html", "text/html")
+
+    async def event_ics(request: web.Request) -> web.Response:
+        return await respond(request, "event.ics", "text/calendar")
+
+    app = web.Application()
+    app.router.add_get("/news/announcements/", announcements)
+    app.router.add_get(r"/news/announcements/page{page:\d+}.html", announcements_page)
+    app.router.add_get(r"/announcements/{event_id:\d+}.html", event)
+    app.router.add_get(r"/events/ics/{event_id:\d+}.ics", event_ics)
+    return app
+
+
+def percentile(values: list[float], q: float) -> float:
+    return statistics.quantiles(values, n=100, method="inclusive")[q - 1] if len(values) > 1 else values[0]
+
+
+async def measure(name: str, engine_name: str, fn, iterations: int, concurrency: int) -> dict:
+    await fn()  # прогрев: соединения, запуск Chrome
+
+    tracemalloc.start()
+    latencies = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        await fn()
+        latencies.append(time.perf_counter() - started)
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    calls_left = iterations
+
+    async def caller():
+        nonlocal calls_left
+        while calls_left > 0:
+            calls_left -= 1
+            await fn()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(caller() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    return {
+        "engine": engine_name,
+        "case": name,
+        "iterations": iterations,
+        "concurrency": concurrency,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 3),
+        "throughput_rps": round(iterations / elapsed, 2),
+        # только память Python-процесса: память Chrome сюда не попадает
+        "peak_memory_kib": round(peak_memory / 1024, 1),
+    }
+
+
+def create_engine(engine_name: str, base_url: str, concurrency: int):
+    if engine_name == "http":
+        return HttpEngine(base_url=base_url, timeout=30)
+    return SeleniumEngine(base_url=base_url,
+                          driver_pool=DriverPool(size=min(concurrency, os.cpu_count() or 1), lease_timeout=60,
+                                                 max_waiters=concurrency))
+
+
+async def run(args) -> dict:
+    runner = web.AppRunner(fixture_app(args.latency / 1000))
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", args.port)
+    await site.start()
+    base_url = f"http://127.0.0.1:{runner.addresses[0][1]}"
+
+    results = []
+    try:
+        for engine_name in args.engines:
+            engine = create_engine(engine_name, base_url, args.concurrency)
+            try:
+                cached_event = await engine.get_event(FIRST_EVENT_ID)
+                cases = [
+                    ("rough_events_page", lambda: engine.get_rough_events(1)),
+                    ("event", lambda: engine.get_event(FIRST_EVENT_ID)),
+                    ("event_revalidation", lambda: engine.get_event(FIRST_EVENT_ID, cached=cached_event)),
+                ]
+                for name, fn in cases:
+                    result = await measure(name, engine_name, fn, args.iterations, args.concurrency)
+                    results.append(result)
+                    print(f"{engine_name:>8} {name:<20} p50 {result['p50_ms']:9.2f} мс  p95 {result['p95_ms']:9.2f} мс  "
+                          f"{result['throughput_rps']:9.1f} запр/с  пик {result['peak_memory_kib']:9.1f} КиБ")
+            finally:
+                await engine.close()
+    finally:
+        await runner.cleanup()
+
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "commit": commit,
+        "datetime": datetime.datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "latency_ms": args.latency,
+        "results": results,
+    }
+
+
+# сравнивает p95 с прошлым прогоном и возвращает False, если что-то замедлилось сильнее допустимого
+def compare_with_baseline(report: dict, baseline: dict, tolerance: float) -> bool:
+    baseline_results = {(result["engine"], result["case"]): result for result in baseline["results"]}
+    ok = True
+    for result in report["results"]:
+        old = baseline_results.get((result["engine"], result["case"]))
+        if old is None:
+            continue
+        ratio = result["p95_ms"] / old["p95_ms"] if old["p95_ms"] else 1
+        regressed = ratio > 1 + tolerance
+        ok = ok and not regressed
+        print(f"{result['engine']:>8} {result['case']:<20} p95 {old['p95_ms']:9.2f} -> {result['p95_ms']:9.2f} мс "
+              f"({ratio:.2f}x){'  РЕГРЕССИЯ' if regressed else ''}")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк скрапинга EXTRA.HSE")
+    parser.add_argument("--engines", nargs="+", choices=["http", "selenium"], default=["http"])
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0, help="искусственная задержка сервера, мс")
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--output", help="куда записать результаты в JSON")
+    parser.add_argument("--baseline", help="JSON прошлого прогона для сравнения")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="допустимое замедление p95, доля")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, ensure_ascii=False, indent=2)
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            if not compare_with_baseline(report, json.load(baseline), args.tolerance):
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
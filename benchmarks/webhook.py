@@ -0,0 +1,103 @@
+# python -m benchmarks.webhook
+#
+# Webhook целиком, без Telegram: локальная заглушка Bot API принимает запросы бота, а апдейты приходят POST-запросами
+# на WebhookServer. Обработчик отвечает на каждое сообщение, как настоящий, с задержкой "работы" HANDLER_DELAY;
+# замеряется, за сколько все апдейты проходят путь webhook -> очередь -> обработчик -> Bot API.
+import asyncio
+import time
+
+import aiohttp
+from aiogram import Bot, Dispatcher
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.types import Message
+from aiohttp import web
+
+from webhook import WebhookServer, SECRET_HEADER
+
+HOST = "127.0.0.1"
+API_PORT = 8781
+WEBHOOK_PORT = 8782
+SECRET = "benchmark"
+HANDLER_DELAY = 0.05
+
+
+# заглушка Bot API: на sendMessage отвечает сообщением, на остальное - True
+class FakeBotAPI:
+    def __init__(self, expected: int):
+        self.sent = 0
+        self.expected = expected
+        self.done = asyncio.Event()
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        data = await request.post()
+        if method != "sendMessage":
+            return web.json_response({"ok": True, "result": True})
+        self.sent += 1
+        if self.sent >= self.expected:
+            self.done.set()
+        return web.json_response({"ok": True, "result": {
+            "message_id": self.sent, "date": int(time.time()),
+            "chat": {"id": int(data["chat_id"]), "type": "private"}, "text": data["text"]}})
+
+
+def make_update(update_id: int) -> dict:
+    user = {"id": 1000 + update_id % 100, "is_bot": False, "first_name": "Тест"}
+    return {"update_id": update_id, "message": {
+        "message_id": update_id, "date": int(time.time()), "from": user,
+        "chat": {"id": user["id"], "type": "private"}, "text": f"сообщение {update_id}"}}
+
+
+async def run(updates: int, workers: int, queue_size: int):
+    fake_api = FakeBotAPI(expected=updates)
+    api_app = web.Application()
+    api_app.router.add_post("/bot{token}/{method}", fake_api.handle)
+    api_runner = web.AppRunner(api_app, access_log=None)
+    await api_runner.setup()
+    await web.TCPSite(api_runner, HOST, API_PORT).start()
+
+    bot = Bot(token="1:benchmark",
+              session=AiohttpSession(api=TelegramAPIServer.from_base(f"http://{HOST}:{API_PORT}")))
+    dp = Dispatcher()
+
+    @dp.message()
+    async def echo(message: Message):
+        await asyncio.sleep(HANDLER_DELAY)
+        await message.answer(message.text)
+
+    server = WebhookServer(dp, bot, workers=workers, queue_size=queue_size, secret=SECRET)
+    await server.start(HOST, WEBHOOK_PORT, "/webhook")
+
+    started = time.perf_counter()
+    statuses = {}
+    async with aiohttp.ClientSession() as session:
+        async def post(update_id: int):
+            async with session.post(f"http://{HOST}:{WEBHOOK_PORT}/webhook", json=make_update(update_id),
+                                    headers={SECRET_HEADER: SECRET}) as response:
+                statuses[response.status] = statuses.get(response.status, 0) + 1
+
+        await asyncio.gather(*(post(update_id) for update_id in range(1, updates + 1)))
+        accepted = time.perf_counter() - started
+        # отклонённые (503) Telegram прислал бы повторно; здесь их просто не ждём
+        fake_api.expected = statuses.get(200, 0)
+        if fake_api.sent >= fake_api.expected:
+            fake_api.done.set()
+        await fake_api.done.wait()
+    elapsed = time.perf_counter() - started
+
+    await server.stop()
+    await bot.session.close()
+    await api_runner.cleanup()
+    print(f"воркеров {workers:>3}, очередь {queue_size:>5}: ответы {statuses}, приём {accepted:.2f} с, "
+          f"обработано {fake_api.sent} за {elapsed:.2f} с ({fake_api.sent / elapsed:.0f} апдейтов/с)")
+
+
+def main():
+    for workers in (1, 8, 32):
+        asyncio.run(run(updates=500, workers=workers, queue_size=1000))
+    asyncio.run(run(updates=500, workers=8, queue_size=100))
+
+
+if __name__ == "__main__":
+    main()
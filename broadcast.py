@@ -0,0 +1,116 @@
+import asyncio
+import enum
+import logging
+from typing import Awaitable, Callable, Iterable
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest
+
+from metrics import timed
+
+
+class BroadcastMessage:
+    def __init__(self, chat_id: int, text: str, key=None):
+        self.chat_id = chat_id
+        self.text = text
+        # то, по чему вызывающий код узнает сообщение в on_done, например id строки в очереди
+        self.key = key
+
+
+class DeliveryResult(enum.Enum):
+    DELIVERED = "delivered"
+    # попытки кончились, можно попробовать позже
+    RETRY_LATER = "retry_later"
+    # доставить не получится никогда: бот заблокирован, чат удалён и т.п.
+    UNDELIVERABLE = "undeliverable"
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at: float | None = None
+        self.paused_until = 0.0
+
+    async def acquire(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            if self.updated_at is not None:
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+            elif self.tokens >= 1:
+                self.tokens -= 1
+                return
+            else:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    # Telegram попросил подождать - ждут все, а не только получивший ответ
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, asyncio.get_running_loop().time() + seconds)
+
+
+# рассылка с общим лимитом ~30 сообщений в секунду на бота и не чаще раза в chat_interval секунд в один чат
+class Broadcaster:
+    def __init__(self, bot: Bot, rate: float, workers: int, chat_interval: float, max_attempts: int = 5):
+        self.bot = bot
+        self.bucket = TokenBucket(rate=rate, capacity=rate)
+        self.workers = workers
+        self.chat_interval = chat_interval
+        self.max_attempts = max_attempts
+        self._in_flight = asyncio.Semaphore(workers)
+        self._chat_next_send: dict[int, float] = {}
+
+    async def _wait_for_chat(self, chat_id: int):
+        loop = asyncio.get_running_loop()
+        next_send = self._chat_next_send.get(chat_id, 0.0)
+        self._chat_next_send[chat_id] = max(next_send, loop.time()) + self.chat_interval
+        if next_send > loop.time():
+            await asyncio.sleep(next_send - loop.time())
+
+    @timed()
+    async def send(self, message: BroadcastMessage) -> DeliveryResult:
+        await self._wait_for_chat(message.chat_id)
+        for attempt in range(1, self.max_attempts + 1):
+            await self.bucket.acquire()
+            async with self._in_flight:
+                try:
+                    await self.bot.send_message(chat_id=message.chat_id, text=message.text)
+                    return DeliveryResult.DELIVERED
+                except TelegramRetryAfter as e:
+                    logging.warning(f"Telegram просит подождать {e.retry_after} с перед отправкой в {message.chat_id}")
+                    self.bucket.pause(e.retry_after)
+                except (TelegramForbiddenError, TelegramBadRequest) as e:
+                    logging.warning(f"Не удалось отправить сообщение в {message.chat_id}: {e}")
+                    return DeliveryResult.UNDELIVERABLE
+                except Exception:
+                    logging.exception(f"Ошибка при отправке сообщения в {message.chat_id}")
+                    return DeliveryResult.RETRY_LATER
+        logging.error(f"Не удалось отправить сообщение в {message.chat_id} за {self.max_attempts} попыток")
+        return DeliveryResult.RETRY_LATER
+
+    # on_done вызывается для каждого сообщения сразу после попытки отправки
+    async def broadcast(self, messages: Iterable[BroadcastMessage],
+                        on_done: Callable[[BroadcastMessage, DeliveryResult], Awaitable[None]]) -> int:
+        queue: asyncio.Queue[BroadcastMessage] = asyncio.Queue()
+        for message in messages:
+            queue.put_nowait(message)
+        sent = 0
+
+        async def worker():
+            nonlocal sent
+            while not queue.empty():
+                message = queue.get_nowait()
+                try:
+                    result = await self.send(message)
+                    await on_done(message, result)
+                    if result == DeliveryResult.DELIVERED:
+                        sent += 1
+                except Exception:
+                    logging.exception(f"Ошибка при рассылке в {message.chat_id}")
+
+        await asyncio.gather(*(worker() for _ in range(min(self.workers, queue.qsize()))))
+        return sent
@@ -1,13 +1,19 @@
+import asyncio
+import logging
+from typing import AsyncIterator
 from urllib.request import urlopen
 
-import dateparser
 import icalendar
 from selenium import webdriver
 from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.common.by import By
 
 from classes import Event, RoughEvent
-from db import async_session, db_get_event_game
+from http_scraper import HttpEngine
+from metrics import timed
+from misc import event_id_from_url, parse_event_date, announcements_page_url
+from tokens import scraper_engine, scraper_fallback, extra_hse_url, scraper_timeout, driver_pool_size, \
+    driver_lease_timeout, driver_pool_max_waiters
 
 options = Options()
 options.add_argument('--headless')
@@ -18,47 +24,230 @@ options.add_argument("disable-infobars")
 options.add_argument("--disable-extensions")
 options.add_argument("window-size=1200x600")
 options.add_argument("headless")
-driver = webdriver.Chrome(options=options)
-
-def get_event_from_internet(event_id: str) -> Event:
-    driver.get(f"https://extra.hse.ru/announcements/{event_id}.html")
-    event_html = driver.find_element(by=By.CLASS_NAME, value="post")
-    event = Event()
-    event.id = event_id
-    event.title = event_html.find_element(by=By.CLASS_NAME, value="post_single").text
-    event.rating = event_html.find_element(by=By.CLASS_NAME, value="rating-round").text
-    event.ical = \
-        icalendar.Calendar.from_ical(urlopen(f"https://extra.hse.ru/events/ics/{event_id}.ics").read()).walk("VEVENT")[
-            0]
-    event.description = event_html.find_element(by=By.CLASS_NAME, value="post__text").text.replace(
-        "Добавить в календарь", "").strip()
-    event.address = event_html.find_elements(by=By.CLASS_NAME, value="articleMetaItem")[1].find_element(
-        by=By.CLASS_NAME, value="articleMetaItem__content").text
-    return event
 
 
-# rough - грубые, то есть не совсем полная информация
-async def get_rough_events_from_internet(with_games: bool):
-    async with async_session() as session:
-        driver.get("https://extra.hse.ru/news/announcements/")
+class DriverPoolBusy(Exception):
+    pass
+
+
+class DriverPool:
+    def __init__(self, size: int, lease_timeout: float, max_waiters: int, probe_after: float = 30):
+        self.size = size
+        self.lease_timeout = lease_timeout
+        self.max_waiters = max_waiters
+        # драйвер, который простаивал дольше probe_after секунд, перед выдачей проверяем на живость
+        self.probe_after = probe_after
+        self._idle: list[tuple[webdriver.Chrome, float]] = []
+        self._created = 0
+        self._available = asyncio.Condition()
+        self._waiters = 0
+        self._closed = False
+
+    @staticmethod
+    def _create_driver() -> webdriver.Chrome:
+        return webdriver.Chrome(options=options)
+
+    @staticmethod
+    def _is_alive(driver: webdriver.Chrome) -> bool:
+        try:
+            driver.execute_script("return 1")
+            return True
+        except Exception:
+            return False
+
+    @staticmethod
+    def _quit(driver: webdriver.Chrome):
+        try:
+            driver.quit()
+        except Exception:
+            logging.exception("Не удалось закрыть Chrome")
+
+    async def _discard(self, driver: webdriver.Chrome):
+        async with self._available:
+            self._created -= 1
+            self._available.notify()
+        await asyncio.to_thread(self._quit, driver)
+
+    @timed()
+    async def _acquire(self) -> webdriver.Chrome:
+        loop = asyncio.get_running_loop()
+        async with self._available:
+            if not self._idle and self._created >= self.size:
+                if self._waiters >= self.max_waiters:
+                    raise DriverPoolBusy("Все браузеры заняты, очередь ожидания переполнена")
+                self._waiters += 1
+                try:
+                    async with asyncio.timeout(self.lease_timeout):
+                        await self._available.wait_for(lambda: self._idle or self._created < self.size)
+                finally:
+                    self._waiters -= 1
+            if self._idle:
+                driver, released_at = self._idle.pop()
+            else:
+                self._created += 1
+                driver, released_at = None, None
+
+        if driver is None:
+            try:
+                return await asyncio.to_thread(self._create_driver)
+            except BaseException:
+                async with self._available:
+                    self._created -= 1
+                    self._available.notify()
+                raise
+        if loop.time() - released_at > self.probe_after and not await asyncio.to_thread(self._is_alive, driver):
+            logging.warning("Chrome не отвечает, перезапускаем")
+            await self._discard(driver)
+            return await self._acquire()
+        return driver
+
+    async def _release(self, driver: webdriver.Chrome, healthy: bool):
+        if not healthy or self._closed:
+            await self._discard(driver)
+            return
+        async with self._available:
+            self._idle.append((driver, asyncio.get_running_loop().time()))
+            self._available.notify()
+
+    async def _release_checked(self, driver: webdriver.Chrome):
+        await self._release(driver, healthy=await asyncio.to_thread(self._is_alive, driver))
+
+    # выполняет блокирующую функцию fn(driver, *args) в отдельном потоке на арендованном драйвере
+    async def run(self, fn, *args):
+        driver = await self._acquire()
+        task = asyncio.ensure_future(asyncio.to_thread(fn, driver, *args))
+        try:
+            result = await asyncio.wait_for(asyncio.shield(task), self.lease_timeout)
+        except TimeoutError:
+            # поток всё ещё держит драйвер - закрываем его, чтобы поток упал, и заводим новый
+            logging.error(f"Аренда Chrome заняла больше {self.lease_timeout} секунд, перезапускаем")
+            task.add_done_callback(lambda finished_task: finished_task.cancelled() or finished_task.exception())
+            await self._discard(driver)
+            raise
+        except asyncio.CancelledError:
+            # поток не отменить, поэтому драйвер вернётся в пул, когда поток закончит работу
+            task.add_done_callback(lambda _: asyncio.ensure_future(self._release_checked(driver)))
+            raise
+        except Exception:
+            # страница могла просто не распарситься, а мог упасть сам Chrome
+            await self._release_checked(driver)
+            raise
+        await self._release(driver, healthy=True)
+        return result
+
+    async def close(self):
+        self._closed = True
+        async with self._available:
+            idle, self._idle = self._idle, []
+            self._created -= len(idle)
+        for driver, _ in idle:
+            await asyncio.to_thread(self._quit, driver)
+
+
+class SeleniumEngine:
+    def __init__(self, base_url: str, driver_pool: DriverPool):
+        self.base_url = base_url
+        # Chrome запускается только при первом обращении
+        self.driver_pool = driver_pool
+
+    @timed()
+    def _get_event(self, driver: webdriver.Chrome, event_id: str) -> Event:
+        driver.get(f"{self.base_url}/announcements/{event_id}.html")
+        event_html = driver.find_element(by=By.CLASS_NAME, value="post")
+        event = Event()
+        event.id = event_id
+        event.title = event_html.find_element(by=By.CLASS_NAME, value="post_single").text
+        event.rating = event_html.find_element(by=By.CLASS_NAME, value="rating-round").text
+        ical = \
+            icalendar.Calendar.from_ical(urlopen(f"{self.base_url}/events/ics/{event_id}.ics").read()).walk("VEVENT")[
+                0]
+        event.start = ical.get("DTSTART").dt
+        event.end = ical.get("DTEND").dt
+        event.description = event_html.find_element(by=By.CLASS_NAME, value="post__text").text.replace(
+            "Добавить в календарь", "").strip()
+        event.address = event_html.find_elements(by=By.CLASS_NAME, value="articleMetaItem")[1].find_element(
+            by=By.CLASS_NAME, value="articleMetaItem__content").text
+        return event
+
+    @timed()
+    def _get_rough_events(self, driver: webdriver.Chrome, page: int) -> list[RoughEvent]:
+        driver.get(announcements_page_url(self.base_url, page))
         driver.implicitly_wait(0.5)
         events_html = driver.find_elements(by=By.CLASS_NAME, value="b-events")
         events = []
         for event_html in events_html:
+            event_link = event_html.find_element(by=By.CLASS_NAME, value="b-events__body_title").find_element(
+                by=By.TAG_NAME, value="a")
             event = RoughEvent()
-            event.id = event_html.find_element(by=By.CLASS_NAME, value="b-events__body_title").find_element(by=By.TAG_NAME,
-                                                                                                            value="a").get_attribute(
-                name="href").split("/")[-1].split(".")[0]
-            event.title = event_html.find_element(by=By.CLASS_NAME, value="b-events__body_title").find_element(
-                by=By.TAG_NAME, value="a").text
-            event_date_text = event_html.find_element(by=By.CLASS_NAME, value="b-events__title").find_element(
-                by=By.CLASS_NAME, value="title").text
-            event.date = dateparser.parse(
-                event_date_text.split(",")[0] if event_date_text[0].isalpha() else event_date_text).replace(hour=0,
-                                                                                                            minute=0,
-                                                                                                            second=0,
-                                                                                                            microsecond=0)
-            db_event_game = await db_get_event_game(session=session, event_id=event.id)
-            if (db_event_game is not None) == with_games:
-                events.append(event)
-        return events
\ No newline at end of file
+            event.id = event_id_from_url(event_link.get_attribute(name="href"))
+            event.title = event_link.text
+            event.date = parse_event_date(event_html.find_element(by=By.CLASS_NAME, value="b-events__title")
+                                          .find_element(by=By.CLASS_NAME, value="title").text)
+            events.append(event)
+        return events
+
+    # Selenium блокирующий, поэтому работает в отдельном потоке и не останавливает event loop
+    # условных запросов Selenium не умеет, поэтому cached не используется
+    async def get_event(self, event_id: str, cached: Event | None = None) -> Event:
+        return await self.driver_pool.run(self._get_event, event_id)
+
+    async def get_rough_events(self, page: int = 1) -> list[RoughEvent]:
+        return await self.driver_pool.run(self._get_rough_events, page)
+
+    async def close(self):
+        await self.driver_pool.close()
+
+
+engines = {
+    "http": lambda: HttpEngine(base_url=extra_hse_url, timeout=scraper_timeout),
+    "selenium": lambda: SeleniumEngine(base_url=extra_hse_url, driver_pool=driver_pool),
+}
+
+driver_pool = DriverPool(size=driver_pool_size, lease_timeout=driver_lease_timeout,
+                         max_waiters=driver_pool_max_waiters)
+
+engine = engines[scraper_engine]()
+fallback_engine = engines["selenium"]() if scraper_fallback and scraper_engine != "selenium" else None
+
+
+# если передать cached, то движок может ответить им же, когда страница мероприятия не изменилась
+@timed()
+async def get_event_from_internet(event_id: str, cached: Event | None = None) -> Event:
+    try:
+        return await engine.get_event(event_id, cached=cached)
+    except Exception:
+        if fallback_engine is None:
+            raise
+        logging.exception(f"Не удалось получить мероприятие {event_id}, пробуем через Selenium")
+        return await fallback_engine.get_event(event_id)
+
+
+# rough - грубые, то есть не совсем полная информация
+@timed()
+async def get_rough_events_from_internet(page: int = 1) -> list[RoughEvent]:
+    try:
+        return await engine.get_rough_events(page)
+    except Exception:
+        if fallback_engine is None:
+            raise
+        logging.exception(f"Не удалось получить {page} страницу анонсов, пробуем через Selenium")
+        return await fallback_engine.get_rough_events(page)
+
+
+# страницы анонсов по очереди, пока они не кончатся
+async def iter_rough_events_pages(max_pages: int) -> AsyncIterator[list[RoughEvent]]:
+    seen_ids = set()
+    for page in range(1, max_pages + 1):
+        rough_events = await get_rough_events_from_internet(page)
+        # некоторые сайты вместо несуществующей страницы отдают последнюю ещё раз
+        rough_events = [rough_event for rough_event in rough_events if rough_event.id not in seen_ids]
+        if not rough_events:
+            return
+        seen_ids.update(rough_event.id for rough_event in rough_events)
+        yield rough_events
+
+
+async def close_browser():
+    await engine.close()
+    if fallback_engine is not None:
+        await fallback_engine.close()
@@ -0,0 +1,226 @@
+import asyncio
+import datetime
+import logging
+from typing import Callable, Awaitable
+
+from browser import iter_rough_events_pages, get_event_from_internet
+from classes import RoughEvent, Event
+from db import async_session, db_get_event_game_ids, db_get_event_details, DBEventDetails, db_save_event_details
+from metrics import timed, register_cache
+from misc import LRUCache
+from tokens import catalog_ttl, catalog_max_stale, event_details_max_age, event_details_cache_size, \
+    catalog_max_pages
+
+
+def is_rough_event_changed(old: RoughEvent, new: RoughEvent) -> bool:
+    return old.title != new.title or old.date != new.date
+
+
+# cold - первое обновление после запуска: каталог живёт только в памяти, поэтому в new попадает всё, что есть на сайте
+class CatalogDiff:
+    def __init__(self, new: list[RoughEvent], changed: list[RoughEvent], removed: list[RoughEvent],
+                 cold: bool = False):
+        self.new = new
+        self.changed = changed
+        self.removed = removed
+        self.cold = cold
+
+    def __bool__(self):
+        return bool(self.new or self.changed or self.removed)
+
+
+# known - каталог до обновления в порядке сайта, crawled - то, что удалось обойти сверху вниз;
+# если обход остановился раньше конца, всё ниже последнего встреченного известного анонса считается неизменным
+def merge_rough_events(known: list[RoughEvent], crawled: list[RoughEvent],
+                       crawl_complete: bool) -> tuple[list[RoughEvent], CatalogDiff]:
+    known_by_id = {rough_event.id: rough_event for rough_event in known}
+    known_positions = {rough_event.id: i for i, rough_event in enumerate(known)}
+    crawled_ids = {rough_event.id for rough_event in crawled}
+
+    new = [rough_event for rough_event in crawled if rough_event.id not in known_by_id]
+    changed = [rough_event for rough_event in crawled
+               if rough_event.id in known_by_id and is_rough_event_changed(known_by_id[rough_event.id], rough_event)]
+
+    if crawl_complete:
+        last_crawled_position = len(known) - 1
+    else:
+        last_crawled_position = max((known_positions[rough_event.id] for rough_event in crawled
+                                     if rough_event.id in known_positions), default=-1)
+    removed = [rough_event for rough_event in known[:last_crawled_position + 1] if rough_event.id not in crawled_ids]
+    rest = [rough_event for rough_event in known[last_crawled_position + 1:] if rough_event.id not in crawled_ids]
+    return crawled + rest, CatalogDiff(new=new, changed=changed, removed=removed, cold=not known)
+
+
+# каталог анонсов EXTRA.HSE, который обновляется в фоне, а не при каждом нажатии кнопки
+class AnnouncementCatalog:
+    def __init__(self, ttl: datetime.timedelta, max_stale: datetime.timedelta, max_pages: int):
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.max_pages = max_pages
+        self.rough_events: list[RoughEvent] | None = None
+        self.refreshed_at: datetime.datetime | None = None
+        self.last_diff: CatalogDiff | None = None
+        self._refresh_task: asyncio.Task | None = None
+        self._subscribers: list[Callable[[CatalogDiff], Awaitable[None]]] = []
+
+    # подписчики узнают о новых, изменившихся и пропавших анонсах после каждого обновления
+    def subscribe(self, callback: Callable[[CatalogDiff], Awaitable[None]]):
+        self._subscribers.append(callback)
+
+    def age(self) -> datetime.timedelta | None:
+        if self.refreshed_at is None:
+            return None
+        return datetime.datetime.now() - self.refreshed_at
+
+    async def refresh(self):
+        # если обновление уже идёт, ждём его, а не запускаем браузер второй раз
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self._refresh())
+        await asyncio.shield(self._refresh_task)
+
+    @timed()
+    async def _refresh(self):
+        known = self.rough_events or []
+        known_by_id = {rough_event.id: rough_event for rough_event in known}
+        crawled = []
+        crawl_complete = True
+        async for page in iter_rough_events_pages(self.max_pages):
+            crawled.extend(page)
+            # целая страница уже известных и не изменившихся анонсов - дальше всё то же самое
+            if known and all(rough_event.id in known_by_id and
+                             not is_rough_event_changed(known_by_id[rough_event.id], rough_event)
+                             for rough_event in page):
+                crawl_complete = False
+                break
+
+        self.rough_events, self.last_diff = merge_rough_events(known, crawled, crawl_complete)
+        self.refreshed_at = datetime.datetime.now()
+        if self.last_diff:
+            logging.info(f"Каталог анонсов: {len(self.last_diff.new)} новых, {len(self.last_diff.changed)} изменилось, "
+                         f"{len(self.last_diff.removed)} пропало")
+            for callback in self._subscribers:
+                try:
+                    await callback(self.last_diff)
+                except Exception:
+                    logging.exception("Подписчик каталога анонсов упал")
+
+    def _refresh_in_background(self):
+        if self._refresh_task is not None and not self._refresh_task.done():
+            return
+        self._refresh_task = asyncio.create_task(self._refresh())
+        self._refresh_task.add_done_callback(self._log_background_error)
+
+    @staticmethod
+    def _log_background_error(task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            logging.error("Не удалось обновить каталог анонсов", exc_info=task.exception())
+
+    async def get(self) -> list[RoughEvent]:
+        age = self.age()
+        if age is None or age > self.max_stale:
+            # холодный старт или каталог слишком старый - придётся подождать
+            try:
+                await self.refresh()
+            except Exception:
+                if self.rough_events is None:
+                    raise
+                logging.exception("Не удалось обновить каталог анонсов, отдаём устаревший")
+        elif age > self.ttl:
+            self._refresh_in_background()
+        return self.rough_events
+
+    async def get_rough_events(self, with_games: bool) -> list[RoughEvent]:
+        rough_events = await self.get()
+        async with async_session() as session:
+            event_game_ids = await db_get_event_game_ids(session)
+        return [rough_event for rough_event in rough_events if (rough_event.id in event_game_ids) == with_games]
+
+
+catalog = AnnouncementCatalog(ttl=datetime.timedelta(seconds=catalog_ttl),
+                              max_stale=datetime.timedelta(seconds=catalog_max_stale),
+                              max_pages=catalog_max_pages)
+
+
+def event_from_db(db_event_details: DBEventDetails) -> Event:
+    event = Event()
+    event.id = db_event_details.event_id
+    event.title = db_event_details.title
+    event.rating = db_event_details.rating
+    event.description = db_event_details.description
+    event.address = db_event_details.address
+    event.start = db_event_details.start.replace(tzinfo=datetime.timezone.utc)
+    event.end = db_event_details.end.replace(tzinfo=datetime.timezone.utc)
+    event.etag = db_event_details.etag
+    event.last_modified = db_event_details.last_modified
+    return event
+
+
+def event_to_db(event: Event, fetched_at: datetime.datetime) -> DBEventDetails:
+    db_event_details = DBEventDetails()
+    db_event_details.event_id = event.id
+    db_event_details.title = event.title
+    db_event_details.rating = event.rating
+    db_event_details.description = event.description
+    db_event_details.address = event.address
+    db_event_details.start = event.start.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    db_event_details.end = event.end.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    db_event_details.etag = event.etag
+    db_event_details.last_modified = event.last_modified
+    db_event_details.fetched_at = fetched_at
+    return db_event_details
+
+
+# подробности мероприятий: сначала память, потом таблица EventDetails, и только потом сайт
+class EventDetailsCache:
+    def __init__(self, max_age: datetime.timedelta, maxsize: int):
+        self.max_age = max_age
+        # event_id -> (Event, когда последний раз сверялись с сайтом)
+        self.memory = LRUCache(maxsize=maxsize)
+        self._fetch_tasks: dict[str, asyncio.Task] = {}
+        self._stale_ids: set[str] = set()
+
+    async def get(self, event_id: str) -> Event:
+        cached = self.memory.get(event_id)
+        if cached is None:
+            async with async_session() as session:
+                db_event_details = await db_get_event_details(session, event_id)
+            if db_event_details is not None:
+                cached = (event_from_db(db_event_details), db_event_details.fetched_at)
+                self.memory.set(event_id, cached)
+
+        if (cached is not None and event_id not in self._stale_ids and
+                datetime.datetime.now() - cached[1] <= self.max_age):
+            return cached[0]
+
+        # несколько одновременных просмотров одного мероприятия ходят на сайт один раз
+        if event_id not in self._fetch_tasks:
+            self._fetch_tasks[event_id] = asyncio.create_task(
+                self._fetch(event_id, cached[0] if cached is not None else None))
+            self._fetch_tasks[event_id].add_done_callback(lambda _: self._fetch_tasks.pop(event_id, None))
+        try:
+            return await asyncio.shield(self._fetch_tasks[event_id])
+        except Exception:
+            if cached is None:
+                raise
+            logging.exception(f"Не удалось обновить мероприятие {event_id}, отдаём сохранённое")
+            return cached[0]
+
+    # изменившиеся и пропавшие анонсы при следующем просмотре перезапрашиваем с сайта
+    async def on_catalog_diff(self, diff: CatalogDiff):
+        for rough_event in diff.changed + diff.removed:
+            self._stale_ids.add(rough_event.id)
+
+    async def _fetch(self, event_id: str, cached: Event | None) -> Event:
+        event = await get_event_from_internet(event_id, cached=cached)
+        fetched_at = datetime.datetime.now()
+        self.memory.set(event_id, (event, fetched_at))
+        self._stale_ids.discard(event_id)
+        async with async_session() as session:
+            await db_save_event_details(session, event_to_db(event, fetched_at))
+        return event
+
+
+event_details = EventDetailsCache(max_age=datetime.timedelta(seconds=event_details_max_age),
+                                  maxsize=event_details_cache_size)
+catalog.subscribe(event_details.on_catalog_diff)
+register_cache("event_details", event_details.memory)
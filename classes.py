@@ -1,7 +1,6 @@
 import datetime
 
 from aiogram.filters.callback_data import CallbackData
-from icalendar.cal import Calendar
 
 
 class RoughEvent:
@@ -14,9 +13,13 @@ class Event:
     id: str
     title: str
     rating: str
-    ical: Calendar
     description: str
     address: str
+    start: datetime.datetime
+    end: datetime.datetime
+    # валидаторы страницы мероприятия для условных запросов, если сайт их прислал
+    etag: str | None = None
+    last_modified: str | None = None
 
 
 class EventsMessageChangePageCallback(CallbackData, prefix="events_message_page"):
@@ -42,9 +45,14 @@ class EventGameStopCallback(CallbackData, prefix="event_game_stop"):
 
 class EventsGamesStopsChangePageCallback(CallbackData, prefix="events_games_stops_page"):
     page: int
+    # event_id последней игры предыдущей страницы или первой игры следующей
+    after: str | None = None
+    before: str | None = None
 
 class EventsGamesQuestionsChangePageCallback(CallbackData, prefix="events_games_qs_page"):
     page: int
+    after: str | None = None
+    before: str | None = None
 
 class EventGameQuestionCallback(CallbackData, prefix="event_game_q"):
     event_id: str
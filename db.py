@@ -1,22 +1,54 @@
 import datetime
 
-from sqlalchemy import BigInteger, ForeignKey, String, Integer, Boolean, DateTime
+from sqlalchemy import BigInteger, ForeignKey, String, Integer, Boolean, DateTime, select, Index, update, func, or_, \
+    and_, false, delete
+from sqlalchemy.dialects.sqlite import insert
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, async_sessionmaker, AsyncAttrs
-from sqlalchemy.orm import Mapped, mapped_column, relationship, DeclarativeBase
+from sqlalchemy.orm import Mapped, mapped_column, relationship, DeclarativeBase, aliased
 
-from misc import DBJSON
+from misc import DBJSON, LRUCache
+from metrics import timed, register_cache
+from tokens import user_cache_size, user_cache_ttl, database_url
 
 
 class Base(AsyncAttrs, DeclarativeBase):
     pass
 
-engine = create_async_engine("sqlite+aiosqlite:///db.db")
+engine = create_async_engine(database_url)
 async_session = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
 
+# профили пользователей для RegistrationMiddleware; сбрасываются при регистрации и изменении баллов или роли
+user_cache = LRUCache(maxsize=user_cache_size, ttl=user_cache_ttl)
+
+# множества event_id, чтобы фильтровать анонсы одним запросом; сбрасываются при записи игр
+event_game_ids_cache = LRUCache(maxsize=1)
+user_event_game_ids_cache = LRUCache(maxsize=10000)
+register_cache("user", user_cache)
+register_cache("event_game_ids", event_game_ids_cache)
+register_cache("user_event_game_ids", user_event_game_ids_cache)
+
+# create_all не трогает уже существующие таблицы, поэтому всё, что меняет схему старого db.db,
+# добавляется сюда; номер последней применённой миграции хранится в PRAGMA user_version
+MIGRATIONS = [
+    [
+        'CREATE INDEX IF NOT EXISTS "ix_EventGames_start" ON "EventGames" ("start")',
+        'CREATE INDEX IF NOT EXISTS "ix_EventGames_end" ON "EventGames" ("end")',
+        'CREATE INDEX IF NOT EXISTS "ix_UserEventGames_event_id" ON "UserEventGames" ("event_id")',
+    ],
+]
+
+async def migrate(conn):
+    version = (await conn.exec_driver_sql("PRAGMA user_version")).scalar()
+    for number, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+        for statement in statements:
+            await conn.exec_driver_sql(statement)
+        await conn.exec_driver_sql(f"PRAGMA user_version = {number}")
+
 async def create_tables():
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        await migrate(conn)
 
 class DBUser(Base):
     __tablename__ = "Users"
@@ -34,10 +66,11 @@ class DBEventGame(Base):
 
     event_id: Mapped[str] = mapped_column(String, primary_key=True)
     event_title: Mapped[str] = mapped_column(String)
-    stops: Mapped[DBJSON] = mapped_column(DBJSON)
-    questions: Mapped[DBJSON] = mapped_column(DBJSON)
-    start: Mapped[datetime.datetime] = mapped_column(DateTime)
-    end: Mapped[datetime.datetime] = mapped_column(DateTime)
+    # точки и вопросы читаются только через game_content, спискам игр они не нужны
+    stops: Mapped[DBJSON] = mapped_column(DBJSON, deferred=True)
+    questions: Mapped[DBJSON] = mapped_column(DBJSON, deferred=True)
+    start: Mapped[datetime.datetime] = mapped_column(DateTime, index=True)
+    end: Mapped[datetime.datetime] = mapped_column(DateTime, index=True)
 
     users = relationship("DBUser", secondary="UserEventGames", back_populates="event_games")
 
@@ -46,13 +79,86 @@ class DBUserEventGame(Base):
     __tablename__ = "UserEventGames"
 
     user_id: Mapped[int] = mapped_column(BigInteger, ForeignKey('Users.user_id'), primary_key=True)
-    event_id: Mapped[str] = mapped_column(String, ForeignKey('EventGames.event_id'), primary_key=True)
+    event_id: Mapped[str] = mapped_column(String, ForeignKey('EventGames.event_id'), primary_key=True, index=True)
     pre_start_notified: Mapped[bool] = mapped_column(Boolean)
     start_notified: Mapped[bool] = mapped_column(Boolean)
     end_notified: Mapped[bool] = mapped_column(Boolean)
     stops_done: Mapped[bool] = mapped_column(Boolean)
     questions_done: Mapped[bool] = mapped_column(Boolean)
 
+class DBEventDetails(Base):
+    __tablename__ = "EventDetails"
+
+    event_id: Mapped[str] = mapped_column(String, primary_key=True)
+    title: Mapped[str] = mapped_column(String)
+    rating: Mapped[str] = mapped_column(String)
+    description: Mapped[str] = mapped_column(String)
+    address: Mapped[str] = mapped_column(String)
+    # время в UTC без часового пояса
+    start: Mapped[datetime.datetime] = mapped_column(DateTime)
+    end: Mapped[datetime.datetime] = mapped_column(DateTime)
+    etag: Mapped[str | None] = mapped_column(String, nullable=True)
+    last_modified: Mapped[str | None] = mapped_column(String, nullable=True)
+    fetched_at: Mapped[datetime.datetime] = mapped_column(DateTime)
+
+class DBPointsLedger(Base):
+    __tablename__ = "PointsLedger"
+
+    user_id: Mapped[int] = mapped_column(BigInteger, ForeignKey('Users.user_id'), primary_key=True)
+    event_id: Mapped[str] = mapped_column(String, ForeignKey('EventGames.event_id'), primary_key=True)
+    # stops или questions: за каждую часть игры баллы начисляются один раз
+    source: Mapped[str] = mapped_column(String, primary_key=True)
+    points: Mapped[int] = mapped_column(Integer)
+    created_at: Mapped[datetime.datetime] = mapped_column(DateTime)
+
+
+class DBOutboxMessage(Base):
+    __tablename__ = "NotificationOutbox"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    # одно и то же уведомление одному человеку в очередь попадает только один раз
+    dedup_key: Mapped[str] = mapped_column(String, unique=True)
+    chat_id: Mapped[int] = mapped_column(BigInteger)
+    text: Mapped[str] = mapped_column(String)
+    # pending, delivered или failed
+    status: Mapped[str] = mapped_column(String, default="pending")
+    attempts: Mapped[int] = mapped_column(Integer, default=0)
+    next_attempt_at: Mapped[datetime.datetime] = mapped_column(DateTime)
+    claimed_by: Mapped[str | None] = mapped_column(String, nullable=True)
+    claimed_until: Mapped[datetime.datetime | None] = mapped_column(DateTime, nullable=True)
+    created_at: Mapped[datetime.datetime] = mapped_column(DateTime)
+    delivered_at: Mapped[datetime.datetime | None] = mapped_column(DateTime, nullable=True)
+
+    __table_args__ = (Index("ix_NotificationOutbox_status_next_attempt_at", "status", "next_attempt_at"),)
+
+
+class DBAISuggestion(Base):
+    __tablename__ = "AISuggestions"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    event_id: Mapped[str] = mapped_column(String)
+    # stops или questions
+    kind: Mapped[str] = mapped_column(String)
+    # при изменении промпта старые ответы перестают подходить
+    prompt_version: Mapped[int] = mapped_column(Integer)
+    content: Mapped[str] = mapped_column(String)
+    tokens: Mapped[int] = mapped_column(Integer)
+    created_at: Mapped[datetime.datetime] = mapped_column(DateTime)
+
+    __table_args__ = (Index("ix_AISuggestions_event_id_kind_prompt_version", "event_id", "kind", "prompt_version"),)
+
+
+class DBFSMRecord(Base):
+    __tablename__ = "FSMRecords"
+
+    # ключ StorageKey, собранный DefaultKeyBuilder
+    key: Mapped[str] = mapped_column(String, primary_key=True)
+    state: Mapped[str | None] = mapped_column(String, nullable=True)
+    data: Mapped[DBJSON] = mapped_column(DBJSON)
+    # по нему удаляются брошенные состояния
+    updated_at: Mapped[datetime.datetime] = mapped_column(DateTime, index=True)
+
+@timed()
 async def db_add_user(session: AsyncSession, user_id: int, user_full_name: str, user_role: str):
     db_user = DBUser()
     db_user.user_id = user_id
@@ -61,12 +167,16 @@ async def db_add_user(session: AsyncSession, user_id: int, user_full_name: str,
     db_user.points = 0
     session.add(db_user)
     await session.commit()
+    user_cache.invalidate(user_id)
 
+@timed()
 async def db_add_event_game(session: AsyncSession, db_event_game: DBEventGame):
     session.add(db_event_game)
     await session.commit()
+    event_game_ids_cache.invalidate()
 
 
+@timed()
 async def db_add_event_game_to_user(session: AsyncSession, user_id: int, event_id: str):
     db_user_event_game = DBUserEventGame()
     db_user_event_game.user_id = user_id
@@ -78,24 +188,176 @@ async def db_add_event_game_to_user(session: AsyncSession, user_id: int, event_i
     db_user_event_game.questions_done = False
     session.add(db_user_event_game)
     await session.commit()
+    user_event_game_ids_cache.invalidate(user_id)
 
 
+# не коммитит: отметку о прохождении и начисление баллов вызывающий код сохраняет вместе;
+# возвращает новую сумму баллов или None, если за эту часть игры баллы уже начислены
+@timed()
+async def db_credit_points(session: AsyncSession, user_id: int, event_id: str, source: str, points: int) -> int | None:
+    result = await session.execute(
+        insert(DBPointsLedger)
+        .values(user_id=user_id, event_id=event_id, source=source, points=points,
+                created_at=datetime.datetime.now())
+        .on_conflict_do_nothing())
+    if result.rowcount == 0:
+        return None
+    return (await session.execute(
+        update(DBUser)
+        .where(DBUser.user_id == user_id)
+        .values(points=DBUser.points + points)
+        .returning(DBUser.points))).scalar_one()
+
+
+@timed()
 async def db_get_user(session: AsyncSession, user_id: int) -> DBUser | None:
     try:
-        db_user = await session.get(DBUser, user_id)
-        if not db_user:
-            return None
-
         return await session.get(DBUser, user_id)
     except SQLAlchemyError:
         return None
 
+# отсоединённый от сессии снимок DBUser: связи вроде event_games у него загрузить нельзя
+@timed()
+async def db_get_cached_user(user_id: int) -> DBUser | None:
+    db_user = user_cache.get(user_id)
+    if db_user is None:
+        async with async_session() as session:
+            db_user = await db_get_user(session, user_id)
+        if db_user is not None:
+            user_cache.set(user_id, db_user)
+    return db_user
+
+@timed()
 async def db_get_event_game(session: AsyncSession, event_id: str) -> DBEventGame | None:
     try:
-        db_event_game = await session.get(DBEventGame, event_id)
-        if not db_event_game:
-            return None
-
         return await session.get(DBEventGame, event_id)
     except SQLAlchemyError:
-        return None
\ No newline at end of file
+        return None
+
+@timed()
+async def db_get_event_game_content(session: AsyncSession,
+                                    event_id: str) -> tuple[str, list[str], list[list[str]]] | None:
+    row = (await session.execute(
+        select(DBEventGame.event_title, DBEventGame.stops, DBEventGame.questions)
+        .where(DBEventGame.event_id == event_id))).first()
+    return tuple(row) if row is not None else None
+
+@timed()
+async def db_get_event_game_ids(session: AsyncSession) -> set[str]:
+    event_game_ids = event_game_ids_cache.get("all")
+    if event_game_ids is None:
+        event_game_ids = set(await session.scalars(select(DBEventGame.event_id)))
+        event_game_ids_cache.set("all", event_game_ids)
+    return event_game_ids
+
+@timed()
+async def db_get_user_event_game_ids(session: AsyncSession, user_id: int) -> set[str]:
+    user_event_game_ids = user_event_game_ids_cache.get(user_id)
+    if user_event_game_ids is None:
+        user_event_game_ids = set(await session.scalars(
+            select(DBUserEventGame.event_id).where(DBUserEventGame.user_id == user_id)))
+        user_event_game_ids_cache.set(user_id, user_event_game_ids)
+    return user_event_game_ids
+
+@timed()
+async def db_get_event_details(session: AsyncSession, event_id: str) -> DBEventDetails | None:
+    try:
+        return await session.get(DBEventDetails, event_id)
+    except SQLAlchemyError:
+        return None
+
+@timed()
+async def db_save_event_details(session: AsyncSession, db_event_details: DBEventDetails):
+    await session.merge(db_event_details)
+    await session.commit()
+
+# варианты подсказок GigaChat в порядке появления
+@timed()
+async def db_get_ai_suggestions(session: AsyncSession, event_id: str, kind: str, prompt_version: int) -> list[str]:
+    return list(await session.scalars(
+        select(DBAISuggestion.content)
+        .where(DBAISuggestion.event_id == event_id, DBAISuggestion.kind == kind,
+               DBAISuggestion.prompt_version == prompt_version)
+        .order_by(DBAISuggestion.id)))
+
+@timed()
+async def db_add_ai_suggestion(session: AsyncSession, event_id: str, kind: str, prompt_version: int, content: str,
+                               tokens: int):
+    db_ai_suggestion = DBAISuggestion()
+    db_ai_suggestion.event_id = event_id
+    db_ai_suggestion.kind = kind
+    db_ai_suggestion.prompt_version = prompt_version
+    db_ai_suggestion.content = content
+    db_ai_suggestion.tokens = tokens
+    db_ai_suggestion.created_at = datetime.datetime.now()
+    session.add(db_ai_suggestion)
+    await session.commit()
+
+# состояние FSM и его данные, если они записаны не раньше fresh_since
+@timed()
+async def db_get_fsm_record(session: AsyncSession, key: str,
+                            fresh_since: datetime.datetime) -> tuple[str | None, dict] | None:
+    row = (await session.execute(
+        select(DBFSMRecord.state, DBFSMRecord.data)
+        .where(DBFSMRecord.key == key, DBFSMRecord.updated_at >= fresh_since))).first()
+    return (row.state, row.data) if row is not None else None
+
+@timed()
+async def db_save_fsm_record(session: AsyncSession, key: str, state: str | None, data: dict):
+    await session.execute(
+        insert(DBFSMRecord)
+        .values(key=key, state=state, data=data, updated_at=datetime.datetime.now())
+        .on_conflict_do_update(index_elements=[DBFSMRecord.key],
+                               set_={"state": state, "data": data, "updated_at": datetime.datetime.now()}))
+    await session.commit()
+
+@timed()
+async def db_delete_fsm_record(session: AsyncSession, key: str):
+    await session.execute(delete(DBFSMRecord).where(DBFSMRecord.key == key))
+    await session.commit()
+
+# удаляет состояния, которые не менялись с older_than; возвращает, сколько удалено
+@timed()
+async def db_delete_stale_fsm_records(session: AsyncSession, older_than: datetime.datetime) -> int:
+    result = await session.execute(delete(DBFSMRecord).where(DBFSMRecord.updated_at < older_than))
+    await session.commit()
+    return result.rowcount
+
+# игры пользователя для /stops (kind="stops") и /questions (kind="questions") одной страницей:
+# окно в 10 дней и отметка о прохождении проверяются в SQL, страница ищется по ключу (start, event_id)
+# относительно after (следующая страница) или before (предыдущая); возвращает [(event_id, event_title)] и общее число
+@timed()
+async def db_get_user_event_games_page(session: AsyncSession, user_id: int, kind: str, now: datetime.datetime,
+                                       after: str | None = None, before: str | None = None,
+                                       limit: int = 5) -> tuple[list[tuple[str, str]], int]:
+    done = DBUserEventGame.stops_done if kind == "stops" else DBUserEventGame.questions_done
+    opens_at = DBEventGame.start if kind == "stops" else DBEventGame.end
+    candidates = (
+        select(DBEventGame.event_id, DBEventGame.event_title, DBEventGame.start, func.count().over().label("total"))
+        .join(DBUserEventGame, DBUserEventGame.event_id == DBEventGame.event_id)
+        .where(DBUserEventGame.user_id == user_id, done == false(),
+               opens_at <= now, DBEventGame.end >= now - datetime.timedelta(days=10))
+        .cte("candidates"))
+
+    page = select(candidates.c.event_id, candidates.c.event_title, candidates.c.total)
+    cursor_id = after if after is not None else before
+    if cursor_id is not None:
+        cursor = aliased(DBEventGame)
+        cursor_start = select(cursor.start).where(cursor.event_id == cursor_id).scalar_subquery()
+        if after is not None:
+            page = page.where(or_(candidates.c.start > cursor_start,
+                                  and_(candidates.c.start == cursor_start, candidates.c.event_id > cursor_id)))
+        else:
+            page = page.where(or_(candidates.c.start < cursor_start,
+                                  and_(candidates.c.start == cursor_start, candidates.c.event_id < cursor_id)))
+    if before is not None:
+        page = page.order_by(candidates.c.start.desc(), candidates.c.event_id.desc())
+    else:
+        page = page.order_by(candidates.c.start, candidates.c.event_id)
+
+    rows = (await session.execute(page.limit(limit))).all()
+    if before is not None:
+        rows.reverse()
+    if not rows:
+        return [], 0
+    return [(event_id, event_title) for event_id, event_title, _ in rows], rows[0].total
\ No newline at end of file
@@ -0,0 +1,69 @@
+import datetime
+import logging
+from typing import Any, Dict, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey, DefaultKeyBuilder
+
+from db import async_session, db_get_fsm_record, db_save_fsm_record, db_delete_fsm_record, \
+    db_delete_stale_fsm_records
+from misc import LRUCache
+
+
+# хранилище FSM в таблице FSMRecords: состояние переживает перезапуск бота. Запись сквозная - сначала в базу,
+# потом в память, поэтому чтение обычно обходится без запроса; пустые записи (после state.clear()) удаляются,
+# а состояния, которые не менялись ttl секунд, считаются брошенными и вычищаются purge.
+# В данных стоит хранить только то, что понимает JSON: идентификаторы вместо объектов
+class SQLiteStorage(BaseStorage):
+    def __init__(self, ttl: float, cache_size: int):
+        self.ttl = ttl
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_business_connection_id=True, with_destiny=True)
+        # ключ -> (state, data); пустая запись тоже кэшируется: FSM читает состояние на каждый апдейт
+        self.memory = LRUCache(maxsize=cache_size, ttl=ttl)
+
+    async def _get(self, key: StorageKey) -> tuple[str | None, dict]:
+        storage_key = self.key_builder.build(key)
+        record = self.memory.get(storage_key)
+        if record is None:
+            async with async_session() as session:
+                record = await db_get_fsm_record(session, storage_key, fresh_since=datetime.datetime.now() -
+                                                 datetime.timedelta(seconds=self.ttl))
+            if record is None:
+                record = (None, {})
+            self.memory.set(storage_key, record)
+        return record
+
+    async def _set(self, key: StorageKey, state: str | None, data: dict):
+        storage_key = self.key_builder.build(key)
+        async with async_session() as session:
+            if state is None and not data:
+                await db_delete_fsm_record(session, storage_key)
+            else:
+                await db_save_fsm_record(session, storage_key, state, data)
+        self.memory.set(storage_key, (state, data))
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        _, data = await self._get(key)
+        await self._set(key, state.state if isinstance(state, State) else state, data)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        state, _ = await self._get(key)
+        return state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        state, _ = await self._get(key)
+        await self._set(key, state, data.copy())
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        _, data = await self._get(key)
+        return data.copy()
+
+    async def purge(self):
+        async with async_session() as session:
+            deleted = await db_delete_stale_fsm_records(
+                session, older_than=datetime.datetime.now() - datetime.timedelta(seconds=self.ttl))
+        if deleted:
+            logging.info(f"Удалено брошенных состояний FSM: {deleted}")
+
+    async def close(self) -> None:
+        pass
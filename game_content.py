@@ -0,0 +1,149 @@
+import re
+
+from aiogram import html
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+
+from classes import EventGameStopCallback, EventGameQuestionCallback, Event
+from db import async_session, db_get_event_game_content, DBEventGame
+from metrics import register_cache
+from misc import LRUCache, moscow_tz
+from tokens import event_game_content_cache_size
+
+NUMBERING_RE = re.compile(r"^(?:\d+\s*[.)]|[-•*])\s*")
+STOP_PREFIX_RE = re.compile(r"^контрольн\w*\s+точк\w*\s*№?\s*\d*\s*:\s*", re.IGNORECASE)
+QUESTION_PREFIX_RE = re.compile(r"^контрольн\w*\s+вопрос\w*\s*№?\s*\d*\s*:\s*", re.IGNORECASE)
+ANSWER_PREFIX_RE = re.compile(r"^ответ\w*\s*№?\s*\d*[^:]{0,20}:\s*", re.IGNORECASE)
+
+
+# точки по одной на строку; нумерация, "Контрольная точка N:" и заголовок вроде "Контрольные точки:" отбрасываются;
+# None, если точек нет или их не expected
+def parse_stops(text: str, expected: int | None = None) -> list[str] | None:
+    stops = []
+    for line in text.splitlines():
+        stop = STOP_PREFIX_RE.sub("", NUMBERING_RE.sub("", line.strip()))
+        if stop:
+            stops.append(stop)
+    if not stops or (expected is not None and len(stops) != expected):
+        return None
+    return stops
+
+
+# вопросы через пустую строку, в каждом - вопрос и три ответа, первый правильный; если пустых строк нет,
+# вопросы берутся по четыре строки; None, если формат не тот или вопросов не expected
+def parse_questions(text: str, expected: int | None = None) -> list[list[str]] | None:
+    blocks = [[line.strip() for line in block.splitlines() if line.strip()]
+              for block in re.split(r"\n\s*\n", text.strip())]
+    # заголовок вроде "Контрольные вопросы:" отдельным абзацем
+    blocks = [block for block in blocks if block and not (len(block) == 1 and block[0].endswith(":"))]
+    if len(blocks) == 1 and len(blocks[0]) > 4 and len(blocks[0]) % 4 == 0:
+        blocks = [blocks[0][i:i + 4] for i in range(0, len(blocks[0]), 4)]
+
+    questions = []
+    for block in blocks:
+        if len(block) != 4:
+            return None
+        question = [QUESTION_PREFIX_RE.sub("", NUMBERING_RE.sub("", block[0]))] + \
+                   [ANSWER_PREFIX_RE.sub("", answer) for answer in block[1:]]
+        if not all(question):
+            return None
+        questions.append(question)
+    if not questions or (expected is not None and len(questions) != expected):
+        return None
+    return questions
+
+
+# обратно в текст, который parse_* разберут: так организатор может поправить подсказку GigaChat и отправить её
+def format_stops(stops: list[str]) -> str:
+    return "\n".join(f"{i}. {stop}" for i, stop in enumerate(stops, start=1))
+
+
+def format_questions(questions: list[list[str]]) -> str:
+    return "\n\n".join("\n".join(question) for question in questions)
+
+
+# новая игра по мероприятию; время в EventGames хранится по Москве без пояса - так же, как его читают из базы
+def new_event_game(event: Event, stops: list[str], questions: list[list[str]]) -> DBEventGame:
+    db_event_game = DBEventGame()
+    db_event_game.event_id = event.id
+    db_event_game.event_title = event.title
+    db_event_game.stops = stops
+    db_event_game.questions = questions
+    db_event_game.start = event.start.astimezone(moscow_tz).replace(tzinfo=None)
+    db_event_game.end = event.end.astimezone(moscow_tz).replace(tzinfo=None)
+    return db_event_game
+
+
+# упакованный CallbackData без последнего поля (points), которое дописывается при нажатии
+def callback_prefix(callback_data) -> str:
+    return callback_data.pack().rsplit(":", 1)[0] + ":"
+
+
+# точки и вопросы игры не меняются после создания, поэтому тексты шагов и callback_data кнопок
+# собираются один раз; при нажатии остаётся только подставить баллы и перемешать ответы
+class EventGameContent:
+    __slots__ = ("event_id", "event_title", "title_html", "stops", "questions", "_stop_prefixes", "_answers")
+
+    def __init__(self, event_id: str, event_title: str, stops: list[str], questions: list[list[str]]):
+        self.event_id = event_id
+        self.event_title = event_title
+        self.title_html = html.bold(event_title)
+        self.stops = tuple(stops)
+        self.questions = tuple(tuple(question) for question in questions)
+        self._stop_prefixes = tuple(
+            callback_prefix(EventGameStopCallback(event_id=event_id, stop_index=stop_index + 1, points=0))
+            for stop_index in range(len(self.stops)))
+        # на каждый вопрос: (текст ответа, префикс callback_data, прибавляет ли ответ балл)
+        self._answers = tuple(
+            tuple((question[answer_index],
+                   callback_prefix(EventGameQuestionCallback(event_id=event_id, question_index=question_index + 1,
+                                                             last_answer_was_right=answer_index == 1, points=0)),
+                   answer_index == 1)
+                  for answer_index in range(1, 3 + 1))
+            for question_index, question in enumerate(self.questions))
+
+    def __setattr__(self, name, value):
+        if hasattr(self, name):
+            raise AttributeError(f"{type(self).__name__} нельзя изменять")
+        super().__setattr__(name, value)
+
+    def stop_text(self, stop_index: int) -> str:
+        return f"{self.title_html}\n\n{self.stops[stop_index]}"
+
+    def stop_keyboard(self, stop_index: int, points: int) -> InlineKeyboardMarkup:
+        prefix = self._stop_prefixes[stop_index]
+        return InlineKeyboardMarkup(inline_keyboard=[[
+            InlineKeyboardButton(text="❌ Не прошёл", callback_data=f"{prefix}{points}"),
+            InlineKeyboardButton(text="✅ Прошёл", callback_data=f"{prefix}{points + 1}"),
+        ]])
+
+    # ответы в том порядке, в котором их показать; перемешивает вызывающий код
+    def question_buttons(self, question_index: int, points: int) -> list[InlineKeyboardButton]:
+        return [InlineKeyboardButton(text=text, callback_data=f"{prefix}{points + 1 if right else points}")
+                for text, prefix, right in self._answers[question_index]]
+
+
+# собранные игры по event_id: заполняется при создании игры или при первом нажатии
+class EventGameContentCache:
+    def __init__(self, maxsize: int):
+        self.memory = LRUCache(maxsize=maxsize)
+
+    async def get(self, event_id: str) -> EventGameContent | None:
+        content = self.memory.get(event_id)
+        if content is None:
+            async with async_session() as session:
+                row = await db_get_event_game_content(session, event_id)
+            if row is None:
+                return None
+            content = EventGameContent(event_id, *row)
+            self.memory.set(event_id, content)
+        return content
+
+    def add(self, db_event_game: DBEventGame) -> EventGameContent:
+        content = EventGameContent(db_event_game.event_id, db_event_game.event_title,
+                                   db_event_game.stops, db_event_game.questions)
+        self.memory.set(db_event_game.event_id, content)
+        return content
+
+
+event_game_contents = EventGameContentCache(maxsize=event_game_content_cache_size)
+register_cache("event_game_contents", event_game_contents.memory)
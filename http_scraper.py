@@ -0,0 +1,198 @@
+import asyncio
+import re
+from html.parser import HTMLParser
+
+import aiohttp
+import icalendar
+
+from classes import Event, RoughEvent
+from metrics import timed
+from misc import event_id_from_url, parse_event_date, announcements_page_url
+
+VOID_TAGS = {"area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "source", "track", "wbr"}
+BLOCK_TAGS = {"address", "article", "aside", "blockquote", "dd", "div", "dl", "dt", "figcaption", "figure", "footer",
+              "form", "h1", "h2", "h3", "h4", "h5", "h6", "header", "hr", "li", "main", "nav", "ol", "p", "pre",
+              "section", "table", "tr", "ul"}
+SKIPPED_TAGS = {"script", "style", "noscript", "template"}
+
+
+class ScrapingError(Exception):
+    pass
+
+
+class HTMLNode:
+    def __init__(self, tag: str, attrs: dict[str, str], parent: "HTMLNode | None"):
+        self.tag = tag
+        self.attrs = attrs
+        self.parent = parent
+        self.children: list["HTMLNode | str"] = []
+
+    @property
+    def classes(self) -> list[str]:
+        return self.attrs.get("class", "").split()
+
+    def find_all(self, class_name: str = None, tag: str = None) -> list["HTMLNode"]:
+        found = []
+        stack = list(reversed(self.children))
+        while stack:
+            node = stack.pop()
+            if isinstance(node, str):
+                continue
+            if (class_name is None or class_name in node.classes) and (tag is None or node.tag == tag):
+                found.append(node)
+            stack.extend(reversed(node.children))
+        return found
+
+    def find(self, class_name: str = None, tag: str = None) -> "HTMLNode":
+        found = self.find_all(class_name=class_name, tag=tag)
+        if not found:
+            raise ScrapingError(f"Не нашли элемент class={class_name} tag={tag} внутри <{self.tag}>")
+        return found[0]
+
+    # примерно то же самое, что .text у элемента Selenium
+    @property
+    def text(self) -> str:
+        pieces = []
+        self._collect_text(pieces)
+        lines = [re.sub(r"\s+", " ", line).strip() for line in "".join(pieces).split("\n")]
+        return "\n".join(line for line in lines if line)
+
+    def _collect_text(self, pieces: list[str]):
+        if self.tag in SKIPPED_TAGS:
+            return
+        if self.tag in BLOCK_TAGS:
+            pieces.append("\n")
+        for child in self.children:
+            if isinstance(child, str):
+                pieces.append(child.replace("\n", " "))
+            elif child.tag == "br":
+                pieces.append("\n")
+            else:
+                child._collect_text(pieces)
+        if self.tag in BLOCK_TAGS:
+            pieces.append("\n")
+
+
+class HTMLTreeBuilder(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.root = HTMLNode("document", {}, None)
+        self.current = self.root
+
+    def handle_starttag(self, tag, attrs):
+        node = HTMLNode(tag, {name: value or "" for name, value in attrs}, self.current)
+        self.current.children.append(node)
+        if tag not in VOID_TAGS:
+            self.current = node
+
+    def handle_endtag(self, tag):
+        # закрываем ближайший открытый тег с таким именем, лишние закрывающие теги игнорируем
+        node = self.current
+        while node is not None and node.tag != tag:
+            node = node.parent
+        if node is not None and node.parent is not None:
+            self.current = node.parent
+
+    def handle_data(self, data):
+        self.current.children.append(data)
+
+
+def parse_html(html: str) -> HTMLNode:
+    builder = HTMLTreeBuilder()
+    builder.feed(html)
+    builder.close()
+    return builder.root
+
+
+def parse_event(event_id: str, event_page: str, event_ics: bytes) -> Event:
+    event_html = parse_html(event_page).find(class_name="post")
+    event = Event()
+    event.id = event_id
+    event.title = event_html.find(class_name="post_single").text
+    event.rating = event_html.find(class_name="rating-round").text
+    ical = icalendar.Calendar.from_ical(event_ics).walk("VEVENT")[0]
+    event.start = ical.get("DTSTART").dt
+    event.end = ical.get("DTEND").dt
+    event.description = event_html.find(class_name="post__text").text.replace("Добавить в календарь", "").strip()
+    meta_items = event_html.find_all(class_name="articleMetaItem")
+    if len(meta_items) < 2:
+        raise ScrapingError(f"У мероприятия {event_id} нет адреса")
+    event.address = meta_items[1].find(class_name="articleMetaItem__content").text
+    return event
+
+
+# rough - грубые, то есть не совсем полная информация
+def parse_rough_events(announcements_page: str) -> list[RoughEvent]:
+    events = []
+    for event_html in parse_html(announcements_page).find_all(class_name="b-events"):
+        event_link = event_html.find(class_name="b-events__body_title").find(tag="a")
+        event = RoughEvent()
+        event.id = event_id_from_url(event_link.attrs.get("href", ""))
+        event.title = event_link.text
+        event.date = parse_event_date(event_html.find(class_name="b-events__title").find(class_name="title").text)
+        events.append(event)
+    return events
+
+
+class HttpEngine:
+    def __init__(self, base_url: str, timeout: float):
+        self.base_url = base_url
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self._session: aiohttp.ClientSession | None = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        # сессию можно создавать только внутри запущенного event loop
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(timeout=self.timeout, raise_for_status=True)
+        return self._session
+
+    async def _get_text(self, url: str) -> str:
+        async with self.session.get(url) as response:
+            return await response.text()
+
+    async def _get_bytes(self, url: str) -> bytes:
+        async with self.session.get(url) as response:
+            return await response.read()
+
+    @timed()
+    async def get_event(self, event_id: str, cached: Event | None = None) -> Event:
+        event_url = f"{self.base_url}/announcements/{event_id}.html"
+        ics_url = f"{self.base_url}/events/ics/{event_id}.ics"
+        headers = {}
+        if cached is not None and cached.etag is not None:
+            headers["If-None-Match"] = cached.etag
+        if cached is not None and cached.last_modified is not None:
+            headers["If-Modified-Since"] = cached.last_modified
+
+        # без кэша страницу и .ics качаем параллельно, с кэшем .ics нужен только если страница изменилась
+        event_ics_task = asyncio.ensure_future(self._get_bytes(ics_url)) if not headers else None
+        try:
+            async with self.session.get(event_url, headers=headers) as response:
+                if response.status == 304:
+                    return cached
+                event_page = await response.text()
+                etag, last_modified = response.headers.get("ETag"), response.headers.get("Last-Modified")
+            event_ics = await (event_ics_task or self._get_bytes(ics_url))
+        finally:
+            if event_ics_task is not None and not event_ics_task.done():
+                event_ics_task.cancel()
+
+        event = parse_event(event_id, event_page, event_ics)
+        event.etag = etag
+        event.last_modified = last_modified
+        return event
+
+    @timed()
+    async def get_rough_events(self, page: int = 1) -> list[RoughEvent]:
+        try:
+            return parse_rough_events(await self._get_text(announcements_page_url(self.base_url, page)))
+        except aiohttp.ClientResponseError as e:
+            # за последней страницей анонсов сайт отвечает 404
+            if e.status == 404 and page > 1:
+                return []
+            raise
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
@@ -0,0 +1,41 @@
+from sortedcontainers import SortedList
+from sqlalchemy import select
+
+from db import async_session, DBUser
+
+
+# рейтинг обычных пользователей по баллам; место ищется за O(log n), а не сортировкой всей таблицы
+class Leaderboard:
+    def __init__(self):
+        self._points: dict[int, int] = {}
+        # (-баллы, user_id), чтобы больше баллов было раньше
+        self._order = SortedList()
+
+    async def load(self):
+        async with async_session() as session:
+            rows = await session.execute(select(DBUser.user_id, DBUser.points).where(DBUser.role == "user"))
+        self._points = {user_id: points for user_id, points in rows}
+        self._order = SortedList((-points, user_id) for user_id, points in self._points.items())
+
+    def update(self, user_id: int, points: int):
+        old_points = self._points.get(user_id)
+        if old_points is not None:
+            self._order.remove((-old_points, user_id))
+        self._points[user_id] = points
+        self._order.add((-points, user_id))
+
+    # у пользователей с одинаковыми баллами одно и то же место
+    def rank(self, user_id: int) -> int | None:
+        points = self._points.get(user_id)
+        if points is None:
+            return None
+        return self._order.bisect_left((-points,)) + 1
+
+    def top(self, n: int) -> list[tuple[int, int]]:
+        return [(user_id, -negative_points) for negative_points, user_id in self._order[:n]]
+
+    def __len__(self):
+        return len(self._order)
+
+
+leaderboard = Leaderboard()
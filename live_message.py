@@ -0,0 +1,53 @@
+import asyncio
+import logging
+import math
+from typing import Callable
+
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.types import Message
+
+
+# сообщение, которое правится по мере того, как приходит текст: update только запоминает последний текст,
+# а правит сообщение фоновая задача не чаще раза в interval секунд, поэтому промежуточные куски сливаются в одну правку
+class LiveMessage:
+    def __init__(self, message: Message, interval: float, render: Callable[[str], str]):
+        self.message = message
+        self.interval = interval
+        self.render = render
+        self._text: str | None = None
+        self._shown: str | None = None
+        self._last_edit = -math.inf
+        self._task: asyncio.Task | None = None
+
+    def update(self, text: str):
+        self._text = text
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._edit_loop())
+
+    async def _edit_loop(self):
+        loop = asyncio.get_running_loop()
+        while self._text != self._shown:
+            await asyncio.sleep(max(0.0, self._last_edit + self.interval - loop.time()))
+            text = self._text
+            try:
+                await self.message.edit_text(self.render(text))
+            except TelegramRetryAfter as e:
+                self._last_edit = loop.time() + e.retry_after - self.interval
+                continue
+            except TelegramBadRequest as e:
+                # например, "message is not modified"; промежуточный текст не важен, ждём следующий
+                logging.warning(f"Не удалось обновить сообщение {self.message.message_id}: {e.message}")
+            self._shown = text
+            self._last_edit = loop.time()
+
+    # останавливает промежуточные правки
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    # последняя правка с окончательным текстом - вместо отдельного сообщения с ответом
+    async def finish(self, text: str, **kwargs):
+        await self.close()
+        await self.message.edit_text(text, **kwargs)
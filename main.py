@@ -6,39 +6,98 @@ import random
 import sys
 from typing import Callable, Dict, Any, Awaitable
 
-import pytz
 from aiogram import Bot, Dispatcher, html, F, BaseMiddleware
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer, PRODUCTION
 from aiogram.enums import ParseMode
 from aiogram.filters import CommandStart, Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.types import Message, CallbackQuery, BotCommand, KeyboardButton, ReplyKeyboardRemove, TelegramObject, \
-    InlineKeyboardButton
+    InlineKeyboardMarkup
 from aiogram.utils.keyboard import InlineKeyboardBuilder, ReplyKeyboardBuilder
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from sqlalchemy import select
 
-from ai import get_stops_from_gigachat, get_questions_from_gigachat
-from browser import get_event_from_internet, get_rough_events_from_internet, driver
-from classes import CreateEventGameCallback, JoinEventGameCallback, EventsMessageChangePageCallback, \
+from broadcast import Broadcaster
+from browser import close_browser
+from catalog import catalog, event_details
+from classes import Event, CreateEventGameCallback, JoinEventGameCallback, EventsMessageChangePageCallback, \
     EventInfoCallback, EventGameStopCallback, EventsGamesStopsChangePageCallback, \
     EventsGamesQuestionsChangePageCallback, EventGameQuestionCallback
-from db import async_session, db_add_event_game_to_user, create_tables, db_get_user, db_add_user, DBUser, DBEventGame, \
-    db_add_event_game, DBUserEventGame, db_get_event_game
-from misc import declension
-from tokens import tg_token
+from db import async_session, db_add_event_game_to_user, create_tables, db_add_user, DBUser, \
+    db_add_event_game, DBUserEventGame, db_get_event_game, db_get_user_event_game_ids, db_get_cached_user, user_cache, \
+    db_credit_points, db_get_user_event_games_page
+from fsm_storage import SQLiteStorage
+from game_content import event_game_contents, parse_stops, parse_questions, new_event_game
+from leaderboard import leaderboard
+from live_message import LiveMessage
+from metrics import UpdateMetricsMiddleware, HandlerMetricsMiddleware, TelegramRequestMetrics, start_metrics_server, \
+    register_cache
+from misc import declension, moscow_tz
+from notifications import NotificationScheduler
+from outbox import NotificationOutbox
+from suggestions import ai_suggestions
+from update_log import UpdateLogSink, update_log_record
+from webhook import run_webhook
+from tokens import tg_token, catalog_refresh_interval, broadcast_rate, broadcast_workers, broadcast_chat_interval, \
+    outbox_workers, outbox_batch_size, outbox_lease, outbox_max_attempts, outbox_poll_interval, update_log_dir, \
+    update_log_queue_size, update_log_batch_size, update_log_flush_interval, update_log_max_bytes, update_log_compress, \
+    metrics_host, metrics_port, gigachat_stream_edit_interval, bot_mode, webhook_url, webhook_host, webhook_port, \
+    webhook_path, webhook_secret, webhook_workers, webhook_queue_size, telegram_api_url, fsm_ttl, fsm_cache_size, \
+    fsm_purge_interval
 
 locale.setlocale(locale.LC_TIME, "ru_RU.UTF-8")
-moscow_tz = pytz.timezone("Europe/Moscow")
 
-bot = Bot(token=tg_token, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+bot = Bot(token=tg_token, default=DefaultBotProperties(parse_mode=ParseMode.HTML),
+          session=AiohttpSession(api=TelegramAPIServer.from_base(telegram_api_url) if telegram_api_url else PRODUCTION))
+bot.session.middleware(TelegramRequestMetrics())
 
-dp = Dispatcher(storage=MemoryStorage())
+fsm_storage = SQLiteStorage(ttl=fsm_ttl, cache_size=fsm_cache_size)
+register_cache("fsm", fsm_storage.memory)
+dp = Dispatcher(storage=fsm_storage)
 
-csv_file_datetime = datetime.datetime.now()
-csv_file_name = f"log-{str(csv_file_datetime)}.csv"
+scheduler = AsyncIOScheduler(timezone='Europe/Moscow')
+broadcaster = Broadcaster(bot, rate=broadcast_rate, workers=broadcast_workers, chat_interval=broadcast_chat_interval)
+outbox = NotificationOutbox(broadcaster, workers=outbox_workers, batch_size=outbox_batch_size,
+                            lease=datetime.timedelta(seconds=outbox_lease), max_attempts=outbox_max_attempts,
+                            poll_interval=outbox_poll_interval)
+notification_scheduler = NotificationScheduler(scheduler, outbox)
+
+update_log = UpdateLogSink(update_log_dir, max_queue=update_log_queue_size, batch_size=update_log_batch_size,
+                           flush_interval=update_log_flush_interval, max_bytes=update_log_max_bytes,
+                           compress=update_log_compress)
+
+
+# идущие генерации GigaChat по user_id организатора, чтобы /cancel мог их остановить
+gigachat_tasks: dict[int, asyncio.Task] = {}
+
+
+# запускает генерацию отдельной задачей и ждёт её; возвращает задачу, которая может быть отменена через /cancel
+# или повторным нажатием: у организатора идёт не больше одной генерации, иначе прежняя держала бы слоты GigaChat
+async def run_gigachat_task(user_id: int, generate: Callable[[], Awaitable[str | None]]) -> asyncio.Task:
+    cancel_gigachat_task(user_id)
+    task = asyncio.create_task(generate())
+    gigachat_tasks[user_id] = task
+    try:
+        await asyncio.wait([task])
+    finally:
+        if gigachat_tasks.get(user_id) is task:
+            del gigachat_tasks[user_id]
+        task.cancel()
+    return task
+
+
+def cancel_gigachat_task(user_id: int):
+    task = gigachat_tasks.pop(user_id, None)
+    if task is not None:
+        task.cancel()
+
+
+# недописанный ответ GigaChat; в нём могут быть незакрытые строки и символы HTML, поэтому экранируется
+def render_gigachat_progress(text: str) -> str:
+    return f"GigaChat пишет...\n\n{html.code(html.quote(text))}"
 
 
 class EventGameCreationStates(StatesGroup):
@@ -61,34 +120,21 @@ class RegistrationMiddleware(BaseMiddleware):
         user = data["event_from_user"]
         state = data["state"]
 
-        with open(csv_file_name, "a") as csv_file:
-            csv_file.write(str(event.update_id)+",")
-            csv_file.write(str(data["event_from_user"].id)+",")
-            csv_file.write("\""+str(datetime.datetime.now())+"\",")
-
-            if event.message:
-                csv_file.write("message,")
-                csv_file.write(event.message.text+"\n")
-            elif event.callback_query:
-                csv_file.write("callback_query,")
-                csv_file.write(event.callback_query.data+"\n")
-            else:
-                csv_file.write("unknown,None\n")
+        update_log.write(update_log_record(event, user.id))
 
-        async with async_session() as session:
-            db_user = await db_get_user(session, user.id)
-
-            if db_user is None:
-                if event.message.text == "/register" or (
-                        await state.get_state() in [RegistrationStates.full_name, RegistrationStates.role]):
-                    result = await handler(event, data)
-                    return result
-                else:
-                    await bot.send_message(data["event_context"].chat.id, "Вы не зарегистрированы в системе. /register")
-            else:
-                data["db_user"] = db_user
+        db_user = await db_get_cached_user(user.id)
+
+        if db_user is None:
+            if event.message.text == "/register" or (
+                    await state.get_state() in [RegistrationStates.full_name, RegistrationStates.role]):
                 result = await handler(event, data)
                 return result
+            else:
+                await bot.send_message(data["event_context"].chat.id, "Вы не зарегистрированы в системе. /register")
+        else:
+            data["db_user"] = db_user
+            result = await handler(event, data)
+            return result
 
 
 
@@ -136,20 +182,40 @@ async def registration_role_handler(message: Message, state: FSMContext):
                               user_id=message.from_user.id,
                               user_full_name=(await state.get_data())["full_name"],
                               user_role=role)
+            if role == "user":
+                leaderboard.update(message.from_user.id, 0)
             await state.clear()
             await message.answer("Спасибо за регистрацию! Введите /start.", reply_markup=ReplyKeyboardRemove())
 
 
 @dp.message(Command("me"))
 async def command_me_handler(message: Message, db_user: DBUser):
+    async with async_session() as session:
+        db_user_event_games_ids = await db_get_user_event_game_ids(session, db_user.user_id)
     await message.answer(
         f"Здравствуйте, {html.bold(db_user.full_name)}! Вот ваш профиль:\n\n"
         f"{html.bold("Роль:")} {button_user if db_user.role == "user" else button_organisator}\n"
         f"{f"{html.bold("Баллов:")} {db_user.points}" if db_user.role == "user" else ""}\n"
-        f"{f"{html.bold("Мероприятий:")} {len(await db_user.awaitable_attrs.event_games)}" if db_user.role == "user" else ""}"
+        f"{f"{html.bold("Место в рейтинге:")} {leaderboard.rank(db_user.user_id)} из {len(leaderboard)}\n" if db_user.role == "user" else ""}"
+        f"{f"{html.bold("Мероприятий:")} {len(db_user_event_games_ids)}" if db_user.role == "user" else ""}"
     )
 
 
+@dp.message(Command("top"))
+async def command_top_handler(message: Message):
+    top = leaderboard.top(10)
+    if not top:
+        await message.answer("Пока что никто не набрал баллов. /start")
+        return
+    async with async_session() as session:
+        full_names = dict((await session.execute(
+            select(DBUser.user_id, DBUser.full_name).where(DBUser.user_id.in_([user_id for user_id, _ in top])))).all())
+    lines = [f"{leaderboard.rank(user_id)}) {html.bold(full_names.get(user_id, "?"))} - "
+             f"{points} {declension(points, "баллов", "балл", "балла")}"
+             for user_id, points in top]
+    await message.answer(f"{html.bold("Лучшие участники:")}\n\n" + "\n".join(lines))
+
+
 @dp.message(CommandStart())
 async def command_start_handler(message: Message, db_user: DBUser) -> None:
     sent_message = await message.answer(
@@ -159,12 +225,11 @@ async def command_start_handler(message: Message, db_user: DBUser) -> None:
 
 async def edit_events_message(sent_message: Message, db_user: DBUser,
                               page_index: int):
-    rough_events = await get_rough_events_from_internet(with_games=(db_user.role == "user"))
+    rough_events = await catalog.get_rough_events(with_games=(db_user.role == "user"))
     if db_user.role == "user":
-        db_user_event_games = await db_user.awaitable_attrs.event_games
-        db_user_event_games_ids = [
-            db_user_event_game.event_id for db_user_event_game in db_user_event_games]
-        rough_events = list(filter(lambda rough_event: rough_event.id not in db_user_event_games_ids, rough_events))
+        async with async_session() as session:
+            db_user_event_games_ids = await db_get_user_event_game_ids(session, db_user.user_id)
+        rough_events = [rough_event for rough_event in rough_events if rough_event.id not in db_user_event_games_ids]
 
     if len(rough_events) == 0:
         await sent_message.edit_text(
@@ -224,7 +289,7 @@ async def events_message_change_page_callback(query: CallbackQuery, callback_dat
 
 @dp.callback_query(EventInfoCallback.filter())
 async def events_message_event_info_callback(query: CallbackQuery, callback_data: EventInfoCallback, db_user: DBUser):
-    event = get_event_from_internet(callback_data.event_id)
+    event = await event_details.get(callback_data.event_id)
 
     inline_keyboard_builder = InlineKeyboardBuilder()
     if db_user.role == "organisator":
@@ -244,8 +309,8 @@ async def events_message_event_info_callback(query: CallbackQuery, callback_data
         f"🔸 {html.bold(event.title)}. {event.rating}\n\n"
         f"{event.description}\n\n"
         f"{html.bold("Где:")} {event.address}\n"
-        f"{html.bold("Начало:")} {event.ical.get("DTSTART").dt.astimezone(moscow_tz).strftime("%d %B %Y %H:%M")}\n"
-        f"{html.bold("Конец:")} {event.ical.get("DTEND").dt.astimezone(moscow_tz).strftime("%d %B %Y %H:%M")}\n"
+        f"{html.bold("Начало:")} {event.start.astimezone(moscow_tz).strftime("%d %B %Y %H:%M")}\n"
+        f"{html.bold("Конец:")} {event.end.astimezone(moscow_tz).strftime("%d %B %Y %H:%M")}\n"
         f"{html.bold(html.link("Ссылка", f"https://extra.hse.ru/announcements/{event.id}.html"))}",
         reply_markup=inline_keyboard_builder.as_markup()
     )
@@ -254,7 +319,7 @@ async def events_message_event_info_callback(query: CallbackQuery, callback_data
 
 @dp.callback_query(CreateEventGameCallback.filter())
 async def create_event_game_callback(query: CallbackQuery, callback_data: CreateEventGameCallback, state: FSMContext):
-    event = get_event_from_internet(callback_data.event_id)
+    event = await event_details.get(callback_data.event_id)
 
     reply_keyboard_builder = ReplyKeyboardBuilder()
     reply_keyboard_builder.row(KeyboardButton(text="✨ Генерация контрольных точек"))
@@ -263,13 +328,29 @@ async def create_event_game_callback(query: CallbackQuery, callback_data: Create
                            f"Мероприятие: {html.bold(event.title)}\n\nВведите, какие контрольные точки нужно пройти участнику. За каждую пройденную контрольную точку пользователь получит +1 балл.\n\nФормат ввода контрольных точек: через перенос строки.\n\nДля отмены введите /cancel.",
                            reply_markup=reply_keyboard_builder.as_markup())
     await state.set_state(EventGameCreationStates.stops)
-    await state.update_data({"event": event})
+    # только id: подробности мероприятия и так лежат в event_details
+    await state.update_data({"event_id": event.id})
     await query.answer()
     await query.message.delete()
 
 
+# мероприятие, для которого создаётся игра: в FSM лежит только его id; если подробности не удаётся получить,
+# организатор узнаёт об этом, а создание игры прерывается, чтобы не падать на каждом следующем сообщении
+async def get_creation_event(message: Message, state: FSMContext) -> Event | None:
+    event_id = (await state.get_data()).get("event_id")
+    try:
+        return await event_details.get(event_id)
+    except Exception:
+        logging.exception(f"Не удалось получить мероприятие {event_id} для создания игры")
+    await message.answer("Не удалось загрузить мероприятие, создание игрового маршрута прервано. Попробуйте позже: /start",
+                         reply_markup=ReplyKeyboardRemove())
+    await state.clear()
+    return None
+
+
 @dp.message(Command("cancel"), EventGameCreationStates.stops)
 async def create_event_game_cancel_stops(message: Message, state: FSMContext):
+    cancel_gigachat_task(message.from_user.id)
     await message.answer("Отменили запись контрольных точек и создание маршрута мероприятия. /start",
                          reply_markup=ReplyKeyboardRemove())
     await state.clear()
@@ -277,27 +358,49 @@ async def create_event_game_cancel_stops(message: Message, state: FSMContext):
 
 @dp.message(F.text, EventGameCreationStates.stops)
 async def create_event_game_stops_handler(message: Message, state: FSMContext):
-    event = (await state.get_data())["event"]
+    event = await get_creation_event(message, state)
+    if event is None:
+        return
 
     # for further bot messages
     reply_keyboard_builder = ReplyKeyboardBuilder()
     reply_keyboard_builder.row(KeyboardButton(text="✨ Генерация контрольных вопросов"))
 
     if message.text == "✨ Генерация контрольных точек":
-        await message.answer("Подождите, пожалуйста...")
-        gigachat_answer = ""
-        i = 0
-        while len(gigachat_answer.split("\n")) not in [6, 7] and i < 3:
-            gigachat_answer = get_stops_from_gigachat(event.title, event.description)
-            i += 1
-
-        if i >= 3:
-            await message.answer(f"GigaChat не смог сформировать контрольные точки. Повторите попытку.")
+        # ответ GigaChat появляется в этом же сообщении по мере генерации
+        live_message = LiveMessage(await message.answer("Подождите, пожалуйста..."),
+                                   interval=gigachat_stream_edit_interval, render=render_gigachat_progress)
+
+        # повторное нажатие показывает следующий вариант
+        variant = (await state.get_data()).get("stops_variant", 0)
+        task = await run_gigachat_task(message.from_user.id,
+                                       lambda: ai_suggestions.get(event, "stops", variant,
+                                                                  live_message.update))
+        if task.cancelled():
+            await live_message.close()
+            return
+        if isinstance(task.exception(), TimeoutError):
+            await live_message.finish("GigaChat не ответил вовремя. Повторите попытку.")
+            return
+        if task.exception() is not None:
+            logging.error(f"Не удалось сгенерировать stops для {event.id}", exc_info=task.exception())
+            await live_message.finish("GigaChat не смог сформировать контрольные точки. Повторите попытку.")
+            return
+        gigachat_answer = task.result()
+        if gigachat_answer is not None:
+            await state.update_data({"stops_variant": variant + 1})
+
+        if gigachat_answer is None:
+            await live_message.finish(f"GigaChat не смог сформировать контрольные точки. Повторите попытку.")
         else:
-            await message.answer(
-                f"GigaChat сформировал такие контрольные точки:\n\n{html.code(gigachat_answer.replace("Контрольные точки:", "").strip())}\n\nВы можете взять этот ответ за основу. Вы также можете запросить у GigaChat сформировать контрольные точки ещё раз - нажмите на кнопку ниже. Как только Вы придумаете контрольные точки, отправьте их нам в ответном сообщении.")
+            await live_message.finish(
+                f"GigaChat сформировал такие контрольные точки:\n\n{html.code(gigachat_answer)}\n\nВы можете взять этот ответ за основу. Вы также можете запросить у GigaChat сформировать контрольные точки ещё раз - нажмите на кнопку ниже. Как только Вы придумаете контрольные точки, отправьте их нам в ответном сообщении.")
     else:
-        await state.update_data({"stops": message.text.split("\n")})
+        stops = parse_stops(message.text)
+        if stops is None:
+            await message.answer("Проверьте правильность введённых данных. Каждая контрольная точка - с новой строки.")
+            return
+        await state.update_data({"stops": stops})
         await message.answer("Хорошо, вписали.", reply_markup=ReplyKeyboardRemove())
         await message.answer(
             f"Мероприятие: {html.bold(event.title)}\n\nВведите контрольные вопросы. Каждый вопрос должен иметь три ответа, первый обязательно должен быть правильным. За каждый правильно отвеченный вопрос пользователь получит +1 балл.\n\nФормат написания контрольных вопросов:\n{html.italic("Контрольный вопрос №1\nОтвет №1 - правильный\nОтвет №2\nОтвет №3\n\nКонтрольный вопрос №2\nОтвет №1 - правильный\nОтвет №2\nОтвет №3\n\n...")}\n\nУчтите, что между контрольными вопросами есть пустая строка. \n\nДля отмены введите /cancel.",
@@ -307,6 +410,7 @@ async def create_event_game_stops_handler(message: Message, state: FSMContext):
 
 @dp.message(Command("cancel"), EventGameCreationStates.questions)
 async def create_event_game_cancel_questions(message: Message, state: FSMContext):
+    cancel_gigachat_task(message.from_user.id)
     await message.answer("Отменили запись контрольных вопросов и создание игрового маршрута мероприятия. /start",
                          reply_markup=ReplyKeyboardRemove())
     await state.clear()
@@ -314,47 +418,53 @@ async def create_event_game_cancel_questions(message: Message, state: FSMContext
 
 @dp.message(F.text, EventGameCreationStates.questions)
 async def create_event_game_questions_handler(message: Message, state: FSMContext):
-    event = (await state.get_data())["event"]
+    event = await get_creation_event(message, state)
+    if event is None:
+        return
 
     if message.text == "✨ Генерация контрольных вопросов":
-        await message.answer("Подождите, пожалуйста...")
-        gigachat_answer = ""
-        i = 0
-        while len(gigachat_answer.split("\n")) != 24 and i < 3:
-            gigachat_answer = get_questions_from_gigachat(event.title, event.description)
-            i += 1
-
-        if i >= 3:
-            await message.answer(f"GigaChat не смог сформировать контрольные вопросы. Повторите попытку.")
+        # ответ GigaChat появляется в этом же сообщении по мере генерации
+        live_message = LiveMessage(await message.answer("Подождите, пожалуйста..."),
+                                   interval=gigachat_stream_edit_interval, render=render_gigachat_progress)
+
+        variant = (await state.get_data()).get("questions_variant", 0)
+        task = await run_gigachat_task(message.from_user.id,
+                                       lambda: ai_suggestions.get(event, "questions", variant,
+                                                                  live_message.update))
+        if task.cancelled():
+            await live_message.close()
+            return
+        if isinstance(task.exception(), TimeoutError):
+            await live_message.finish("GigaChat не ответил вовремя. Повторите попытку.")
+            return
+        if task.exception() is not None:
+            logging.error(f"Не удалось сгенерировать questions для {event.id}", exc_info=task.exception())
+            await live_message.finish("GigaChat не смог сформировать контрольные вопросы. Повторите попытку.")
+            return
+        gigachat_answer = task.result()
+        if gigachat_answer is not None:
+            await state.update_data({"questions_variant": variant + 1})
+
+        if gigachat_answer is None:
+            await live_message.finish(f"GigaChat не смог сформировать контрольные вопросы. Повторите попытку.")
         else:
-            await message.answer(
+            await live_message.finish(
                 f"GigaChat сформировал такие контрольные вопросы:\n\n{html.code(gigachat_answer)}\n\nВы можете взять этот ответ за основу. Вы также можете запросить у GigaChat сформировать контрольные вопросы ещё раз - нажмите на кнопку ниже. Как только Вы придумаете контрольные вопросы, отправьте их нам в ответном сообщении.")
     else:
-        # first of all, check
-        questions_and_answers = message.text.split("\n\n")
-        if not all(len(question_and_answers.split("\n")) == 4 for question_and_answers in questions_and_answers):
+        # тот же разбор, что и для ответов GigaChat
+        questions = parse_questions(message.text)
+        if questions is None:
             await message.answer("Проверьте правильность введённых данных. У каждого вопроса по три ответа.")
             return
 
-        questions = [question_and_answers.split("\n") for question_and_answers in questions_and_answers]
-        for i in range(len(questions)):
-            if questions[i][0].startswith("Контрольный вопрос"): questions[i][0] = ":".join(
-                questions[i][0].split(":")[1:]).strip()
-            for j in range(1, 3 + 1):
-                if questions[i][j].startswith("Ответ"): questions[i][j] = ":".join(
-                    questions[i][j].split(":")[1:]).strip()
-
         await state.update_data({"questions": questions})
         await message.answer("Хорошо, вписали.", reply_markup=ReplyKeyboardRemove())
         async with async_session() as session:
-            db_event_game = DBEventGame()
-            db_event_game.event_id = event.id
-            db_event_game.event_title = event.title
-            db_event_game.stops = (await state.get_data())["stops"]
-            db_event_game.questions = (await state.get_data())["questions"]
-            db_event_game.start = event.ical.get("DTSTART").dt.astimezone(moscow_tz)
-            db_event_game.end = event.ical.get("DTEND").dt.astimezone(moscow_tz)
+            db_event_game = new_event_game(event, (await state.get_data())["stops"],
+                                           (await state.get_data())["questions"])
             await db_add_event_game(session, db_event_game)
+            event_game_contents.add(db_event_game)
+            notification_scheduler.schedule_event_game(db_event_game)
 
             await message.answer(
                 "Игровой маршрут создан! Теперь пользователи данного бота могут принять участие в Вашем мероприятии.",
@@ -369,6 +479,7 @@ async def join_event_game_callback(query: CallbackQuery, callback_data: JoinEven
             session=session,
             user_id=db_user.user_id,
             event_id=callback_data.event_id)
+        notification_scheduler.schedule_event_game(await db_get_event_game(session, callback_data.event_id))
         await query.message.edit_text(f"{html.bold("Вы успешно записались на данное мероприятие!")} "
                                       "За час до и в начале мероприятия мы уведомим Вас о нём. "
                                       "Во время мероприятия будет доступен список контрольных "
@@ -378,40 +489,6 @@ async def join_event_game_callback(query: CallbackQuery, callback_data: JoinEven
         await query.answer()
 
 
-async def send_notifications():
-    async with async_session() as session:
-        should_commit = False
-        db_event_games = await session.execute(select(DBEventGame))
-        for db_event_game in db_event_games.scalars():
-            notify_about_pre_start = datetime.datetime.now(tz=moscow_tz) >= moscow_tz.localize(db_event_game.start) - datetime.timedelta(hours=1)
-            notify_about_start = datetime.datetime.now(tz=moscow_tz) >= moscow_tz.localize(db_event_game.start)
-            notify_about_end = datetime.datetime.now(tz=moscow_tz) >= moscow_tz.localize(db_event_game.end)
-
-            db_users: list[DBUser] = await db_event_game.awaitable_attrs.users
-            for db_user in db_users:
-                db_user_event_game = await session.get(DBUserEventGame, (db_user.user_id, db_event_game.event_id))
-                if notify_about_pre_start and not db_user_event_game.pre_start_notified:
-                    await bot.send_message(
-                        chat_id=db_user.user_id,
-                        text=f"{html.bold(db_user.full_name)}, через час состоится мероприятие {html.bold(db_event_game.event_title)}. Не опаздывайте!")
-                    db_user_event_game.pre_start_notified = True
-                    should_commit = True
-                if notify_about_start and not db_user_event_game.start_notified:
-                    await bot.send_message(
-                        chat_id=db_user.user_id,
-                        text=f"{html.bold(db_user.full_name)}, началось мероприятие {html.bold(db_event_game.event_title)}. Чтобы начать проходить контрольные точки мероприятия, напишите /stops.")
-                    db_user_event_game.start_notified = True
-                    should_commit = True
-                if notify_about_end and not db_user_event_game.end_notified:
-                    await bot.send_message(
-                        chat_id=db_user.user_id,
-                        text=f"{html.bold(db_user.full_name)}, мероприятие {html.bold(db_event_game.event_title)} завершено. Предлагаем ответить на вопросы после мероприятия: /questions.")
-                    db_user_event_game.end_notified = True
-                    should_commit = True
-        if should_commit:
-            await session.commit()
-
-
 @dp.message(Command("stops"))
 async def stops_command_handler(message: Message, state: FSMContext, db_user: DBUser):
     if db_user.role != "user":
@@ -423,53 +500,50 @@ async def stops_command_handler(message: Message, state: FSMContext, db_user: DB
     await edit_stops_events_message(sent_message=sent_message, db_user=db_user, page_index=0)
 
 
-async def edit_stops_events_message(sent_message: Message, db_user: DBUser, page_index: int):
+async def edit_stops_events_message(sent_message: Message, db_user: DBUser, page_index: int,
+                                    after: str | None = None, before: str | None = None):
     async with async_session() as session:
-        db_event_games: list[DBEventGame] = await db_user.awaitable_attrs.event_games
-        db_event_games_filtered: list[DBEventGame] = []
-        for db_event_game in db_event_games:
-            if (moscow_tz.localize(db_event_game.end) + datetime.timedelta(days=10) >=
-                    datetime.datetime.now(tz=moscow_tz) >=
-                    moscow_tz.localize(db_event_game.start)
-                    and
-                    not (await session.get(DBUserEventGame, (db_user.user_id, db_event_game.event_id))).stops_done):
-                db_event_games_filtered.append(db_event_game)
-        db_event_games = db_event_games_filtered
-
-        if len(db_event_games) == 0:
+        db_event_games, total = await db_get_user_event_games_page(
+            session, db_user.user_id, "stops", datetime.datetime.now(tz=moscow_tz).replace(tzinfo=None),
+            after=after, before=before)
+        if not db_event_games and (after is not None or before is not None):
+            # игры с соседней страницы успели закончиться - начинаем сначала
+            page_index = 0
+            db_event_games, total = await db_get_user_event_games_page(
+                session, db_user.user_id, "stops", datetime.datetime.now(tz=moscow_tz).replace(tzinfo=None))
+
+        if total == 0:
             await sent_message.edit_text(
                 f"Здравствуйте, {html.bold(db_user.full_name)}! Вы пока что не принимаете участие ни в каком мероприятии, в котором нужно проходить контрольные точки. Если Вы прошли все контрольные точки всех мероприятий, на которые Вы записались, то Вы - большой молодец! /start"
             )
             return
 
-        db_event_games_limited = db_event_games[page_index*5:page_index*5+5]
-
-        max_pages = ((len(db_event_games) - 1) // 5 + 1) - 1
+        max_pages = ((total - 1) // 5 + 1) - 1
+        page_index = min(page_index, max_pages)
 
         inline_keyboard_builder = InlineKeyboardBuilder()
-        for i in range(len(db_event_games_limited)):
+        for i in range(len(db_event_games)):
             inline_keyboard_builder.button(text=f"{(page_index * 5) + i + 1}",
                                            callback_data=EventGameStopCallback(
-                                               event_id=db_event_games_limited[i].event_id,
+                                               event_id=db_event_games[i][0],
                                                stop_index=0,
                                                points=0))
         if page_index != 0:
             inline_keyboard_builder.button(text="◀️",
                                            callback_data=EventsGamesStopsChangePageCallback(
-                                               page=max(page_index - 1, 0)))
+                                               page=max(page_index - 1, 0), before=db_event_games[0][0]))
         if page_index != max_pages:
             inline_keyboard_builder.button(text="▶️️",
                                            callback_data=EventsGamesStopsChangePageCallback(
-                                               page=min(page_index + 1, max_pages)))
+                                               page=min(page_index + 1, max_pages), after=db_event_games[-1][0]))
 
-        inline_keyboard_builder.adjust(len(db_event_games_limited), int(page_index != 0) + int(page_index != max_pages))
+        inline_keyboard_builder.adjust(len(db_event_games), int(page_index != 0) + int(page_index != max_pages))
 
         await sent_message.edit_text(
             f"Здравствуйте, {html.bold(db_user.full_name)}! "
             f"Пожалуйста, выберите мероприятие, чьи контрольные точки Вы хотите пройти:\n\n"
-            f"{"\n\n".join([f"{db_event_games.index(db_event_game) + 1}) " +
-                            html.bold(db_event_game.event_title)
-                            for db_event_game in db_event_games_limited])}\n\n"
+            f"{"\n\n".join([f"{page_index * 5 + i + 1}) " + html.bold(event_title)
+                            for i, (_, event_title) in enumerate(db_event_games)])}\n\n"
             f"Нажмите на любую из кнопок ниже, чтобы начать выполнять контрольные точки.",
             reply_markup=inline_keyboard_builder.as_markup())
 
@@ -480,38 +554,35 @@ async def events_games_stops_change_page_callback(query: CallbackQuery, callback
     await edit_stops_events_message(
         sent_message=query.message,
         db_user=db_user,
-        page_index=callback_data.page)
+        page_index=callback_data.page,
+        after=callback_data.after,
+        before=callback_data.before)
     await query.answer()
 
 
 @dp.callback_query(EventGameStopCallback.filter())
 async def event_game_stop_callback(query: CallbackQuery, callback_data: EventGameStopCallback, db_user: DBUser):
-    async with async_session() as session:
-        db_event_game = await db_get_event_game(session, callback_data.event_id)
-        stops: list[str] = db_event_game.stops
-        stop_index = callback_data.stop_index
+    content = await event_game_contents.get(callback_data.event_id)
+    stop_index = callback_data.stop_index
 
-        if callback_data.stop_index >= len(stops):
-            ball = declension(callback_data.points, "баллов", "балл", "балла")
+    if stop_index >= len(content.stops):
+        ball = declension(callback_data.points, "баллов", "балл", "балла")
 
-            recent_db_user = await session.get(DBUser, db_user.user_id)
-            recent_db_user.points = recent_db_user.points + callback_data.points
-            db_user_event_game = await session.get(DBUserEventGame, (db_user.user_id, db_event_game.event_id))
+        async with async_session() as session:
+            points = await db_credit_points(session, db_user.user_id, callback_data.event_id, "stops",
+                                            callback_data.points)
+            db_user_event_game = await session.get(DBUserEventGame, (db_user.user_id, callback_data.event_id))
             db_user_event_game.stops_done = True
             await session.commit()
-            await query.message.edit_text(
-                f"{html.bold(db_event_game.event_title)}\n\n"
-                f"Вы успешно прошли контрольные точки мероприятия и получили за это {html.bold(f"{callback_data.points} {ball}")}! После завершения мероприятия не забудьте ответить на вопросы: /questions.")
-        else:
-            inline_keyboard_builder = InlineKeyboardBuilder()
-            inline_keyboard_builder.button(text="❌ Не прошёл", callback_data=EventGameStopCallback(
-                    event_id=callback_data.event_id, stop_index=callback_data.stop_index+1, points=callback_data.points))
-            inline_keyboard_builder.button(text="✅ Прошёл", callback_data=EventGameStopCallback(
-                    event_id=callback_data.event_id, stop_index=callback_data.stop_index+1, points=callback_data.points+1))
-
-            await query.message.edit_text(
-                f"{html.bold(db_event_game.event_title)}\n\n"
-                f"{stops[stop_index]}", reply_markup=inline_keyboard_builder.as_markup())
+        if points is not None:
+            leaderboard.update(db_user.user_id, points)
+        user_cache.invalidate(db_user.user_id)
+        await query.message.edit_text(
+            f"{content.title_html}\n\n"
+            f"Вы успешно прошли контрольные точки мероприятия и получили за это {html.bold(f"{callback_data.points} {ball}")}! После завершения мероприятия не забудьте ответить на вопросы: /questions.")
+    else:
+        await query.message.edit_text(content.stop_text(stop_index),
+                                      reply_markup=content.stop_keyboard(stop_index, callback_data.points))
 
 
 @dp.message(Command("questions"))
@@ -525,54 +596,51 @@ async def questions_command_handler(message: Message, state: FSMContext, db_user
     await edit_questions_events_message(sent_message=sent_message, db_user=db_user, page_index=0)
 
 
-async def edit_questions_events_message(sent_message: Message, db_user: DBUser, page_index: int):
+async def edit_questions_events_message(sent_message: Message, db_user: DBUser, page_index: int,
+                                        after: str | None = None, before: str | None = None):
     async with async_session() as session:
-        db_event_games: list[DBEventGame] = await db_user.awaitable_attrs.event_games
-        db_event_games_filtered: list[DBEventGame] = []
-        for db_event_game in db_event_games:
-            if (moscow_tz.localize(db_event_game.end) + datetime.timedelta(days=10) >=
-                    datetime.datetime.now(tz=moscow_tz) >=
-                    moscow_tz.localize(db_event_game.end)
-                    and
-                    not (await session.get(DBUserEventGame, (db_user.user_id, db_event_game.event_id))).questions_done):
-                db_event_games_filtered.append(db_event_game)
-        db_event_games = db_event_games_filtered
-
-        if len(db_event_games) == 0:
+        db_event_games, total = await db_get_user_event_games_page(
+            session, db_user.user_id, "questions", datetime.datetime.now(tz=moscow_tz).replace(tzinfo=None),
+            after=after, before=before)
+        if not db_event_games and (after is not None or before is not None):
+            # игры с соседней страницы успели закончиться - начинаем сначала
+            page_index = 0
+            db_event_games, total = await db_get_user_event_games_page(
+                session, db_user.user_id, "questions", datetime.datetime.now(tz=moscow_tz).replace(tzinfo=None))
+
+        if total == 0:
             await sent_message.edit_text(
                 f"Здравствуйте, {html.bold(db_user.full_name)}! Вы пока что не принимаете участие ни в каком мероприятии, в котором нужно отвечать на контрольные вопросы. Если Вы ответили на все контрольные вопросы всех мероприятий, на которые Вы записались, то Вы - большой молодец! /start"
             )
             return
 
-        db_event_games_limited = db_event_games[page_index*5:page_index*5+5]
-
-        max_pages = ((len(db_event_games) - 1) // 5 + 1) - 1
+        max_pages = ((total - 1) // 5 + 1) - 1
+        page_index = min(page_index, max_pages)
 
         inline_keyboard_builder = InlineKeyboardBuilder()
-        for i in range(len(db_event_games_limited)):
+        for i in range(len(db_event_games)):
             inline_keyboard_builder.button(text=f"{(page_index * 5) + i + 1}",
                                            callback_data=EventGameQuestionCallback(
-                                               event_id=db_event_games_limited[i].event_id,
+                                               event_id=db_event_games[i][0],
                                                last_answer_was_right=True,
                                                question_index=0,
                                                points=0))
         if page_index != 0:
             inline_keyboard_builder.button(text="◀️",
                                            callback_data=EventsGamesQuestionsChangePageCallback(
-                                               page=max(page_index - 1, 0)))
+                                               page=max(page_index - 1, 0), before=db_event_games[0][0]))
         if page_index != max_pages:
             inline_keyboard_builder.button(text="▶️️",
                                            callback_data=EventsGamesQuestionsChangePageCallback(
-                                               page=min(page_index + 1, max_pages)))
+                                               page=min(page_index + 1, max_pages), after=db_event_games[-1][0]))
 
-        inline_keyboard_builder.adjust(len(db_event_games_limited), int(page_index != 0) + int(page_index != max_pages))
+        inline_keyboard_builder.adjust(len(db_event_games), int(page_index != 0) + int(page_index != max_pages))
 
         await sent_message.edit_text(
             f"Здравствуйте, {html.bold(db_user.full_name)}! "
             f"Пожалуйста, выберите мероприятие, контрольные вопросы которого Вы хотите пройти:\n\n"
-            f"{"\n\n".join([f"{db_event_games.index(db_event_game) + 1}) " +
-                            html.bold(db_event_game.event_title)
-                            for db_event_game in db_event_games_limited])}\n\n"
+            f"{"\n\n".join([f"{page_index * 5 + i + 1}) " + html.bold(event_title)
+                            for i, (_, event_title) in enumerate(db_event_games)])}\n\n"
             f"Нажмите на любую из кнопок ниже, чтобы начать отвечать на контрольные вопросы.",
             reply_markup=inline_keyboard_builder.as_markup())
 
@@ -583,61 +651,45 @@ async def events_games_questions_change_page_callback(query: CallbackQuery, call
     await edit_questions_events_message(
         sent_message=query.message,
         db_user=db_user,
-        page_index=callback_data.page)
+        page_index=callback_data.page,
+        after=callback_data.after,
+        before=callback_data.before)
     await query.answer()
 
 
 @dp.callback_query(EventGameQuestionCallback.filter())
 async def event_game_stop_callback(query: CallbackQuery, callback_data: EventGameQuestionCallback, db_user: DBUser):
-    async with async_session() as session:
-        db_event_game = await db_get_event_game(session, callback_data.event_id)
-        questions: list[list[str]] = db_event_game.questions
-        question_index = callback_data.question_index
+    content = await event_game_contents.get(callback_data.event_id)
+    question_index = callback_data.question_index
 
-        if question_index != 0:
-            await query.answer(f"✅ Правильно!\n\n" if callback_data.last_answer_was_right else "❌ Неправильно :(\n\n")
+    if question_index != 0:
+        await query.answer(f"✅ Правильно!\n\n" if callback_data.last_answer_was_right else "❌ Неправильно :(\n\n")
 
-        if callback_data.question_index >= len(questions):
-            ball = declension(callback_data.points, "баллов", "балл", "балла")
+    if question_index >= len(content.questions):
+        ball = declension(callback_data.points, "баллов", "балл", "балла")
 
-            recent_db_user = await session.get(DBUser, db_user.user_id)
-            recent_db_user.points = recent_db_user.points + callback_data.points
-            db_user_event_game = await session.get(DBUserEventGame, (db_user.user_id, db_event_game.event_id))
+        async with async_session() as session:
+            points = await db_credit_points(session, db_user.user_id, callback_data.event_id, "questions",
+                                            callback_data.points)
+            db_user_event_game = await session.get(DBUserEventGame, (db_user.user_id, callback_data.event_id))
             db_user_event_game.questions_done = True
             await session.commit()
-            await query.message.edit_text(
-                f"{html.bold(db_event_game.event_title)}\n\n"
-                f"{"✅ Правильно!\n\n" if callback_data.last_answer_was_right else "❌ Неправильно :(\n\n"}"
-                f"Вы успешно ответили на все контрольные вопросы мероприятия и получили за это {html.bold(f"{callback_data.points} {ball}")}! Посмотрите, какие мероприятия Вас ещё могут заинтересовать: /start.")
-        else:
-            question = questions[question_index]
-            inline_keyboard_builder = InlineKeyboardBuilder()
-            buttons = [
-                InlineKeyboardButton(text=question[1], callback_data=EventGameQuestionCallback(
-                    event_id=callback_data.event_id, question_index=callback_data.question_index+1,
-                    last_answer_was_right=True, points=callback_data.points+1
-                ).pack()),
-                InlineKeyboardButton(text=question[2], callback_data=EventGameQuestionCallback(
-                    event_id=callback_data.event_id, question_index=callback_data.question_index+1,
-                    last_answer_was_right=False, points=callback_data.points
-                ).pack()),
-                InlineKeyboardButton(text=question[3], callback_data=EventGameQuestionCallback(
-                    event_id=callback_data.event_id, question_index=callback_data.question_index+1,
-                    last_answer_was_right=False, points=callback_data.points
-                ).pack()),
-            ]
-
-            random.shuffle(buttons)
-
-            for button in buttons:
-                inline_keyboard_builder.add(button)
-
-            inline_keyboard_builder.adjust(1, 1, 1)
-
-            await query.message.edit_text(
-                f"{html.bold(db_event_game.event_title)}\n\n"
-                f"{("✅ Правильно!\n\n" if callback_data.last_answer_was_right else "❌ Неправильно :(\n\n") if callback_data.question_index != 0 else ""}"
-                f"{question[0]}", reply_markup=inline_keyboard_builder.as_markup())
+        if points is not None:
+            leaderboard.update(db_user.user_id, points)
+        user_cache.invalidate(db_user.user_id)
+        await query.message.edit_text(
+            f"{content.title_html}\n\n"
+            f"{"✅ Правильно!\n\n" if callback_data.last_answer_was_right else "❌ Неправильно :(\n\n"}"
+            f"Вы успешно ответили на все контрольные вопросы мероприятия и получили за это {html.bold(f"{callback_data.points} {ball}")}! Посмотрите, какие мероприятия Вас ещё могут заинтересовать: /start.")
+    else:
+        buttons = content.question_buttons(question_index, callback_data.points)
+        random.shuffle(buttons)
+
+        await query.message.edit_text(
+            f"{content.title_html}\n\n"
+            f"{("✅ Правильно!\n\n" if callback_data.last_answer_was_right else "❌ Неправильно :(\n\n") if question_index != 0 else ""}"
+            f"{content.questions[question_index][0]}",
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=[[button] for button in buttons]))
 
 
 @dp.message(F.text)
@@ -650,24 +702,54 @@ async def start_bot():
         BotCommand(command='start', description='Старт'),
         BotCommand(command='cancel', description='Отмена действия'),
         BotCommand(command='me', description='Посмотреть профиль'),
+        BotCommand(command='top', description='Рейтинг участников'),
         BotCommand(command='stops', description="Начать прохождение контрольных точек"),
         BotCommand(command='questions', description="Начать отвечать на вопросы")
     ]
     await bot.set_my_commands(commands)
-    with open(csv_file_name, "w") as csv_file:
-        csv_file.write("update_id,user_id,datetime,event_type,data\n")
 
 async def main() -> None:
+    # ошибку в настройках приёма апдейтов видно сразу, а не после запуска планировщика и сервера
+    if bot_mode not in ("polling", "webhook"):
+        raise ValueError(f"BOT_MODE должен быть polling или webhook, а не {bot_mode!r}")
+    if bot_mode == "webhook" and not webhook_url:
+        raise ValueError("Для BOT_MODE=webhook нужно указать WEBHOOK_URL")
     await create_tables()
+    await leaderboard.load()
     dp.startup.register(start_bot)
-    scheduler = AsyncIOScheduler(timezone='Europe/Moscow')
-    job = scheduler.add_job(send_notifications, 'interval', minutes=1)
+    await notification_scheduler.rebuild()
+    catalog_job = scheduler.add_job(catalog.refresh, 'interval', seconds=catalog_refresh_interval,
+                                    next_run_time=datetime.datetime.now(tz=moscow_tz))
+    outbox_purge_job = scheduler.add_job(outbox.purge, 'interval', days=1)
+    fsm_purge_job = scheduler.add_job(fsm_storage.purge, 'interval', seconds=fsm_purge_interval)
     scheduler.start()
+    outbox.start()
+    update_log.start()
+    ai_suggestions.start()
+    # первым, чтобы в метрики попадало и время RegistrationMiddleware
+    dp.update.outer_middleware(UpdateMetricsMiddleware())
     dp.update.outer_middleware(RegistrationMiddleware())
-    await dp.start_polling(bot)
+    dp.message.middleware(HandlerMetricsMiddleware())
+    dp.callback_query.middleware(HandlerMetricsMiddleware())
+    metrics_runner = await start_metrics_server(metrics_host, metrics_port) if metrics_port else None
+    if bot_mode == "webhook":
+        await run_webhook(dp, bot, url=webhook_url, host=webhook_host, port=webhook_port, path=webhook_path,
+                          workers=webhook_workers, queue_size=webhook_queue_size, secret=webhook_secret)
+    else:
+        await bot.delete_webhook()
+        await dp.start_polling(bot)
+    await outbox.stop()
+    await update_log.stop()
+    await ai_suggestions.stop()
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+    logging.info(f"Кэш профилей пользователей: {user_cache.stats()}")
     await bot.session.close()
-    scheduler.remove_job(job.id)
-    driver.quit()
+    scheduler.remove_job(catalog_job.id)
+    scheduler.remove_job(outbox_purge_job.id)
+    scheduler.remove_job(fsm_purge_job.id)
+    scheduler.shutdown(wait=False)
+    await close_browser()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,245 @@
+import asyncio
+import bisect
+import collections
+import functools
+import inspect
+import logging
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.types import TelegramObject
+from aiohttp import web
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+# гистограмма в духе Prometheus: на каждый набор меток - счётчики по корзинам, сумма и число наблюдений
+class Histogram:
+    def __init__(self, name: str, help_text: str, label_names: tuple[str, ...], buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = tuple(buckets)
+        # метки -> [счётчики по корзинам..., сумма, число]
+        self._series: dict[tuple[str, ...], list] = {}
+        # наблюдения приходят и из потоков (Selenium, GigaChat)
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values: str):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * len(self.buckets) + [0.0, 0]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series_items = [(label_values, list(series)) for label_values, series in sorted(self._series.items())]
+        for label_values, series in series_items:
+            labels = ",".join(f'{name}="{escape_label_value(value)}"'
+                              for name, value in zip(self.label_names, label_values))
+            prefix = f"{labels}," if labels else ""
+            cumulative = 0
+            for bucket, count in zip(self.buckets, series):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bucket}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{prefix}le="+Inf"}} {series[-1]}')
+            lines.append(f"{self.name}_sum{{{labels}}} {series[-2]}")
+            lines.append(f"{self.name}_count{{{labels}}} {series[-1]}")
+        return lines
+
+
+update_duration = Histogram("bot_update_duration_seconds", "Обработка апдейта целиком, включая middleware",
+                            ("event_type",))
+handler_duration = Histogram("bot_handler_duration_seconds", "Время работы обработчика aiogram",
+                             ("handler", "status"))
+stage_duration = Histogram("bot_stage_duration_seconds",
+                           "Этапы внутри обработчиков: Selenium, SQLite, GigaChat, Telegram API, рассылки",
+                           ("stage", "status"))
+histograms = [update_duration, handler_duration, stage_duration]
+
+# кэши (misc.LRUCache) по имени: попадания и промахи отдаются как счётчики, размер - как gauge
+caches: dict[str, Any] = {}
+
+
+def register_cache(name: str, cache):
+    caches[name] = cache
+
+
+def render_caches() -> list[str]:
+    lines = []
+    for metric, metric_type, help_text, attribute in [
+        ("bot_cache_hits_total", "counter", "Попадания в кэш", "hits"),
+        ("bot_cache_misses_total", "counter", "Промахи кэша", "misses"),
+        ("bot_cache_size", "gauge", "Записей в кэше", "__len__"),
+    ]:
+        lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} {metric_type}"]
+        for name, cache in sorted(caches.items()):
+            value = len(cache) if attribute == "__len__" else getattr(cache, attribute)
+            lines.append(f'{metric}{{cache="{escape_label_value(name)}"}} {value}')
+    return lines
+
+
+@contextmanager
+def span(stage: str):
+    started = time.perf_counter()
+    status = "ok"
+    try:
+        yield
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        stage_duration.observe(time.perf_counter() - started, stage, status)
+
+
+# @timed() над функцией или корутиной - этап с именем "модуль.функция"
+def timed(stage: str | None = None):
+    def decorator(fn):
+        name = stage or f"{fn.__module__}.{fn.__qualname__}"
+
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with span(name):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# внешний middleware на dp.update: весь апдейт, включая регистрацию и журнал
+class UpdateMetricsMiddleware(BaseMiddleware):
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any]
+    ) -> Any:
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            update_duration.observe(time.perf_counter() - started, event.event_type)
+
+
+# внутренний middleware на dp.message и dp.callback_query: здесь уже известно, какой обработчик выбран
+class HandlerMetricsMiddleware(BaseMiddleware):
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any]
+    ) -> Any:
+        handler_object = data.get("handler")
+        name = handler_object.callback.__name__ if handler_object is not None else "unknown"
+        started = time.perf_counter()
+        status = "ok"
+        try:
+            return await handler(event, data)
+        except BaseException:
+            status = "error"
+            raise
+        finally:
+            handler_duration.observe(time.perf_counter() - started, name, status)
+
+
+# запросы бота к Telegram API: bot.session.middleware(TelegramRequestMetrics())
+class TelegramRequestMetrics(BaseRequestMiddleware):
+    async def __call__(self, make_request, bot, method):
+        with span(f"telegram.{method.__api_method__}"):
+            return await make_request(bot, method)
+
+
+# сэмплирующий профайлер: отдельный поток раз в interval секунд снимает стек потока цикла событий;
+# результат - "свёрнутые" стеки (функция;функция;... число), которые понимают flamegraph.pl и speedscope
+class SamplingProfiler:
+    def __init__(self):
+        self.samples: collections.Counter[str] = collections.Counter()
+        self._thread: threading.Thread | None = None
+        self._stop = threading.Event()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    def start(self, interval: float, thread_id: int):
+        if self.running:
+            return
+        self.samples.clear()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample, args=(interval, thread_id), daemon=True)
+        self._thread.start()
+
+    def _sample(self, interval: float, thread_id: int):
+        while not self._stop.wait(interval):
+            frame = sys._current_frames().get(thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(f"{frame.f_code.co_filename.rsplit('/', 1)[-1]}:{frame.f_code.co_name}")
+                frame = frame.f_back
+            if stack:
+                self.samples[";".join(reversed(stack))] += 1
+
+    def stop(self) -> str:
+        if self.running:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        return "".join(f"{stack} {count}\n" for stack, count in self.samples.most_common())
+
+
+profiler = SamplingProfiler()
+
+
+def render_metrics() -> str:
+    lines = [line for histogram in histograms for line in histogram.render()] + render_caches()
+    return "\n".join(lines) + "\n"
+
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(text=render_metrics(), content_type="text/plain", charset="utf-8",
+                        headers={"X-Content-Type-Options": "nosniff"})
+
+
+# POST /profiler/start?interval=0.005 - включить, POST /profiler/stop - выключить и получить стеки
+async def profiler_start_handler(request: web.Request) -> web.Response:
+    profiler.start(float(request.query.get("interval", 0.005)), request.app["loop_thread_id"])
+    return web.Response(text="started\n")
+
+
+async def profiler_stop_handler(request: web.Request) -> web.Response:
+    return web.Response(text=await asyncio.to_thread(profiler.stop))
+
+
+# по умолчанию сервер слушает только 127.0.0.1: метрики и профайлер наружу не открываются
+async def start_metrics_server(host: str, port: int) -> web.AppRunner:
+    app = web.Application()
+    app["loop_thread_id"] = threading.get_ident()
+    app.router.add_get("/metrics", metrics_handler)
+    app.router.add_post("/profiler/start", profiler_start_handler)
+    app.router.add_post("/profiler/stop", profiler_stop_handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.info(f"Метрики доступны на http://{host}:{port}/metrics")
+    return runner
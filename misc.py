@@ -1,7 +1,16 @@
-import json
+import datetime
+import functools
+import re
+import time
+from collections import OrderedDict
 
+import dateparser
+import orjson
+import pytz
 from sqlalchemy import types
 
+moscow_tz = pytz.timezone("Europe/Moscow")
+
 
 class DBJSON(types.TypeDecorator):
     impl = types.String
@@ -9,10 +18,47 @@ class DBJSON(types.TypeDecorator):
     cache_ok = True
 
     def process_bind_param(self, value, dialect):
-        return json.dumps(value)
+        return orjson.dumps(value).decode()
 
     def process_result_value(self, value, dialect):
-        return json.loads(value)
+        return orjson.loads(value)
+
+
+# LRU-кэш с ограниченным размером; если задан ttl (в секундах), записи старше него считаются отсутствующими
+class LRUCache:
+    def __init__(self, maxsize: int, ttl: float | None = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict = OrderedDict()
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None or (self.ttl is not None and time.monotonic() - item[1] > self.ttl):
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return item[0]
+
+    def set(self, key, value):
+        self._data[key] = (value, time.monotonic())
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key=None):
+        if key is None:
+            self._data.clear()
+        else:
+            self._data.pop(key, None)
+
+    def stats(self) -> dict:
+        return {"size": len(self._data), "hits": self.hits, "misses": self.misses}
+
+    def __len__(self):
+        return len(self._data)
 
 
 # число, "0 друзей", "1 друг", "2 друга"
@@ -26,4 +72,44 @@ def declension(n, form_0, form_1, form_2):
     if units == 1:
         return form_1
     if units in [2, 3, 4]:
-        return form_2
\ No newline at end of file
+        return form_2
+
+
+# первая страница анонсов - /news/announcements/, остальные - /news/announcements/page2.html и т.д.
+def announcements_page_url(base_url: str, page: int) -> str:
+    if page == 1:
+        return f"{base_url}/news/announcements/"
+    return f"{base_url}/news/announcements/page{page}.html"
+
+
+# "https://extra.hse.ru/announcements/123.html" -> "123"
+def event_id_from_url(url: str) -> str:
+    return url.split("/")[-1].split(".")[0]
+
+
+MONTHS = {"января": 1, "февраля": 2, "марта": 3, "апреля": 4, "мая": 5, "июня": 6,
+          "июля": 7, "августа": 8, "сентября": 9, "октября": 10, "ноября": 11, "декабря": 12}
+# "17 января", "17 января 2025", "пятница, 17 января", "17 января – 2 февраля", "17–19 января"
+EVENT_DATE_RE = re.compile(r"(\d{1,2})(?:\s*[–—-]\s*\d{1,2})?\s+(" + "|".join(MONTHS) + r")(?:\s+(\d{4}))?")
+
+
+@functools.lru_cache(maxsize=1024)
+def _parse_event_date(event_date_text: str, today: datetime.date) -> datetime.datetime:
+    match = EVENT_DATE_RE.search(event_date_text.lower())
+    if match is not None:
+        day, month, year = match.groups()
+        try:
+            return datetime.datetime(int(year) if year else today.year, MONTHS[month], int(day))
+        except ValueError:
+            pass
+    # незнакомый формат - отдаём dateparser, он медленный, но понимает почти всё
+    return dateparser.parse(
+        event_date_text.split(",")[0] if event_date_text[0].isalpha() else event_date_text).replace(hour=0,
+                                                                                                    minute=0,
+                                                                                                    second=0,
+                                                                                                    microsecond=0)
+
+
+# "сегодня" и "завтра" зависят от текущего дня, поэтому он тоже часть ключа кэша
+def parse_event_date(event_date_text: str) -> datetime.datetime:
+    return _parse_event_date(event_date_text.strip(), datetime.date.today())
@@ -0,0 +1,105 @@
+import datetime
+import logging
+
+from aiogram import html
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from sqlalchemy import select, false, update, or_
+
+from db import async_session, DBEventGame, DBUserEventGame, DBUser
+from metrics import timed
+from misc import moscow_tz
+from outbox import NotificationOutbox, OutboxItem
+
+# вид уведомления -> флаг в UserEventGames, который ставится после отправки
+NOTIFICATION_FLAGS = {
+    "pre_start": DBUserEventGame.pre_start_notified,
+    "start": DBUserEventGame.start_notified,
+    "end": DBUserEventGame.end_notified,
+}
+
+
+# условие "уведомление уже пора отправлять" на стороне SQL; время в EventGames хранится по Москве без пояса
+def notification_due(kind: str, now: datetime.datetime):
+    now = now.astimezone(moscow_tz).replace(tzinfo=None)
+    if kind == "pre_start":
+        return DBEventGame.start <= now + datetime.timedelta(hours=1)
+    if kind == "start":
+        return DBEventGame.start <= now
+    return DBEventGame.end <= now
+
+
+# время в EventGames - московское без пояса, но на всякий случай принимается и время с поясом
+def localize(value: datetime.datetime) -> datetime.datetime:
+    return value.astimezone(moscow_tz) if value.tzinfo is not None else moscow_tz.localize(value)
+
+
+def notification_time(db_event_game: DBEventGame, kind: str) -> datetime.datetime:
+    if kind == "pre_start":
+        return localize(db_event_game.start) - datetime.timedelta(hours=1)
+    if kind == "start":
+        return localize(db_event_game.start)
+    return localize(db_event_game.end)
+
+
+def notification_text(db_user: DBUser, db_event_game: DBEventGame, kind: str) -> str:
+    if kind == "pre_start":
+        return f"{html.bold(db_user.full_name)}, через час состоится мероприятие {html.bold(db_event_game.event_title)}. Не опаздывайте!"
+    if kind == "start":
+        return f"{html.bold(db_user.full_name)}, началось мероприятие {html.bold(db_event_game.event_title)}. Чтобы начать проходить контрольные точки мероприятия, напишите /stops."
+    return f"{html.bold(db_user.full_name)}, мероприятие {html.bold(db_event_game.event_title)} завершено. Предлагаем ответить на вопросы после мероприятия: /questions."
+
+
+# на каждую игру и вид уведомления - своя задача APScheduler ровно на нужное время,
+# вместо того чтобы раз в минуту перебирать все игры
+class NotificationScheduler:
+    def __init__(self, scheduler: AsyncIOScheduler, outbox: NotificationOutbox):
+        self.scheduler = scheduler
+        self.outbox = outbox
+
+    def schedule_event_game(self, db_event_game: DBEventGame):
+        now = datetime.datetime.now(tz=moscow_tz)
+        for kind in NOTIFICATION_FLAGS:
+            # уже наступившие уведомления (например, пользователь записался после начала) отправляем сразу
+            self.scheduler.add_job(self.notify, 'date', run_date=max(notification_time(db_event_game, kind), now),
+                                   args=[db_event_game.event_id, kind], id=f"notify:{db_event_game.event_id}:{kind}",
+                                   replace_existing=True, misfire_grace_time=None)
+
+    # после перезапуска планируем только игры, у которых остались неотправленные уведомления
+    async def rebuild(self):
+        async with async_session() as session:
+            db_event_games = (await session.scalars(
+                select(DBEventGame)
+                .where(DBEventGame.event_id.in_(
+                    select(DBUserEventGame.event_id)
+                    .where(or_(*(flag == false() for flag in NOTIFICATION_FLAGS.values())))
+                    .distinct())))).all()
+            for db_event_game in db_event_games:
+                self.schedule_event_game(db_event_game)
+        logging.info(f"Запланированы уведомления для {len(db_event_games)} игр")
+
+    # сама рассылка - дело воркеров очереди, здесь сообщения только ставятся в неё вместе с флагами
+    @timed()
+    async def notify(self, event_id: str, kind: str):
+        flag = NOTIFICATION_FLAGS[kind]
+        async with async_session() as session:
+            # только те участники, кому уведомление ещё не отправлено и уже пора
+            rows = (await session.execute(
+                select(DBUser, DBEventGame)
+                .select_from(DBUserEventGame)
+                .join(DBUser, DBUser.user_id == DBUserEventGame.user_id)
+                .join(DBEventGame, DBEventGame.event_id == DBUserEventGame.event_id)
+                .where(DBUserEventGame.event_id == event_id, flag == false(),
+                       notification_due(kind, datetime.datetime.now(tz=moscow_tz))))).all()
+            if not rows:
+                return
+            await self.outbox.enqueue(session, [
+                OutboxItem(dedup_key=f"{kind}:{event_id}:{db_user.user_id}", chat_id=db_user.user_id,
+                           text=notification_text(db_user, db_event_game, kind))
+                for db_user, db_event_game in rows])
+            await session.execute(update(DBUserEventGame)
+                                  .where(DBUserEventGame.event_id == event_id,
+                                         DBUserEventGame.user_id.in_([db_user.user_id for db_user, _ in rows]))
+                                  .values({flag.key: True}))
+            await session.commit()
+        logging.info(f"Уведомление {kind} о {event_id}: в очереди {len(rows)} сообщений")
+        self.outbox.wake()
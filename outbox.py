@@ -0,0 +1,132 @@
+import asyncio
+import datetime
+import logging
+import uuid
+
+from sqlalchemy import select, update, delete, or_
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from broadcast import Broadcaster, BroadcastMessage, DeliveryResult
+from db import async_session, DBOutboxMessage
+from metrics import timed
+
+
+class OutboxItem:
+    def __init__(self, dedup_key: str, chat_id: int, text: str):
+        self.dedup_key = dedup_key
+        self.chat_id = chat_id
+        self.text = text
+
+
+# очередь исходящих уведомлений в SQLite: планировщик только кладёт в неё сообщения,
+# а доставляют их воркеры, которых может быть несколько и в разных процессах
+class NotificationOutbox:
+    def __init__(self, broadcaster: Broadcaster, workers: int, batch_size: int, lease: datetime.timedelta,
+                 max_attempts: int, poll_interval: float):
+        self.broadcaster = broadcaster
+        self.workers = workers
+        self.batch_size = batch_size
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self._wakeup = asyncio.Event()
+        self._tasks: list[asyncio.Task] = []
+
+    # не коммитит: вызывающий код кладёт сообщения и ставит флаги в одной транзакции
+    @staticmethod
+    async def enqueue(session: AsyncSession, items: list[OutboxItem]):
+        if not items:
+            return
+        now = datetime.datetime.now()
+        # у SQLite есть лимит на число параметров в одном запросе
+        for i in range(0, len(items), 500):
+            await session.execute(
+                insert(DBOutboxMessage)
+                .values([{"dedup_key": item.dedup_key, "chat_id": item.chat_id, "text": item.text, "status": "pending",
+                          "attempts": 0, "next_attempt_at": now, "created_at": now} for item in items[i:i + 500]])
+                .on_conflict_do_nothing(index_elements=["dedup_key"]))
+
+    def wake(self):
+        self._wakeup.set()
+
+    # один UPDATE ... WHERE id IN (SELECT ...) в SQLite атомарен, поэтому два воркера не заберут одну строку
+    async def claim(self) -> list[DBOutboxMessage]:
+        token = uuid.uuid4().hex
+        now = datetime.datetime.now()
+        async with async_session() as session:
+            await session.execute(
+                update(DBOutboxMessage)
+                .where(DBOutboxMessage.id.in_(
+                    select(DBOutboxMessage.id)
+                    .where(DBOutboxMessage.status == "pending", DBOutboxMessage.next_attempt_at <= now,
+                           or_(DBOutboxMessage.claimed_until.is_(None), DBOutboxMessage.claimed_until < now))
+                    .order_by(DBOutboxMessage.id)
+                    .limit(self.batch_size)))
+                .values(claimed_by=token, claimed_until=now + self.lease)
+                .execution_options(synchronize_session=False))
+            await session.commit()
+            return list(await session.scalars(
+                select(DBOutboxMessage).where(DBOutboxMessage.claimed_by == token,
+                                              DBOutboxMessage.status == "pending")))
+
+    def backoff(self, attempts: int) -> datetime.timedelta:
+        return datetime.timedelta(seconds=min(30 * 2 ** (attempts - 1), 3600))
+
+    async def _on_done(self, message: BroadcastMessage, result: DeliveryResult):
+        db_outbox_message: DBOutboxMessage = message.key
+        now = datetime.datetime.now()
+        values = {"claimed_by": None, "claimed_until": None, "attempts": db_outbox_message.attempts + 1}
+        if result == DeliveryResult.DELIVERED:
+            values.update(status="delivered", delivered_at=now)
+        elif result == DeliveryResult.UNDELIVERABLE or values["attempts"] >= self.max_attempts:
+            values.update(status="failed")
+        else:
+            values.update(next_attempt_at=now + self.backoff(values["attempts"]))
+        async with async_session() as session:
+            # строку меняет только тот, кто её забрал, иначе аренда уже истекла и её взял другой воркер
+            await session.execute(update(DBOutboxMessage)
+                                  .where(DBOutboxMessage.id == db_outbox_message.id,
+                                         DBOutboxMessage.claimed_by == db_outbox_message.claimed_by)
+                                  .values(values))
+            await session.commit()
+
+    @timed()
+    async def deliver_batch(self) -> int:
+        db_outbox_messages = await self.claim()
+        if not db_outbox_messages:
+            return 0
+        await self.broadcaster.broadcast(
+            [BroadcastMessage(chat_id=db_outbox_message.chat_id, text=db_outbox_message.text, key=db_outbox_message)
+             for db_outbox_message in db_outbox_messages], self._on_done)
+        return len(db_outbox_messages)
+
+    async def _worker(self):
+        while True:
+            self._wakeup.clear()
+            try:
+                if await self.deliver_batch():
+                    continue
+            except Exception:
+                logging.exception("Ошибка при разборе очереди уведомлений")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except TimeoutError:
+                pass
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    # доставленные и окончательно не доставленные сообщения старше older_than больше не нужны
+    async def purge(self, older_than: datetime.timedelta = datetime.timedelta(days=7)):
+        async with async_session() as session:
+            await session.execute(delete(DBOutboxMessage)
+                                  .where(DBOutboxMessage.status != "pending",
+                                         DBOutboxMessage.created_at < datetime.datetime.now() - older_than))
+            await session.commit()
@@ -0,0 +1,178 @@
+import asyncio
+import collections
+import itertools
+import logging
+import time
+from typing import Callable
+
+from ai import generate_suggestion, PROMPT_VERSIONS, GENERATORS
+from catalog import CatalogDiff, catalog, event_details
+from classes import Event
+from db import async_session, db_get_ai_suggestions, db_add_ai_suggestion, db_get_event_game_ids
+from metrics import register_cache
+from misc import LRUCache
+from tokens import ai_pregeneration_token_budget, ai_pregeneration_budget_window, ai_suggestion_max_variants, \
+    ai_suggestion_cache_size
+
+# чем меньше, тем раньше: догенерация следующего варианта для организатора, который уже ждёт,
+# важнее подготовки подсказок для мероприятий, которые, может быть, никто и не выберет
+PRIORITY_NEXT_VARIANT = 0
+PRIORITY_PREGENERATION = 1
+
+
+# подсказки GigaChat для точек и вопросов: память -> таблица AISuggestions -> модель;
+# в фоне одна задача заранее готовит подсказки для новых мероприятий, не тратя больше token_budget токенов за budget_window секунд
+class AISuggestions:
+    def __init__(self, token_budget: int, budget_window: float, max_variants: int, cache_size: int):
+        self.token_budget = token_budget
+        self.budget_window = budget_window
+        self.max_variants = max_variants
+        # (event_id, kind, prompt_version) -> список вариантов в порядке появления
+        self.memory = LRUCache(maxsize=cache_size)
+        self._queue: asyncio.PriorityQueue = asyncio.PriorityQueue()
+        # (event_id, kind) -> (priority, wanted) той записи в очереди, которая действительна; остальные пропускаются
+        self._queued: dict[tuple[str, str], tuple[int, int]] = {}
+        # (event_id, kind) -> идущая генерация, чтобы организатор и фоновая задача не генерировали одно и то же дважды
+        self._in_flight: dict[tuple[str, str], asyncio.Future] = {}
+        self._order = itertools.count()
+        # (когда, сколько токенов) фоновых генераций за последнее окно
+        self._spent: collections.deque[tuple[float, int]] = collections.deque()
+        self._task: asyncio.Task | None = None
+
+    async def variants(self, event_id: str, kind: str) -> list[str]:
+        key = (event_id, kind, PROMPT_VERSIONS[kind])
+        variants = self.memory.get(key)
+        if variants is None:
+            async with async_session() as session:
+                variants = await db_get_ai_suggestions(session, event_id, kind, PROMPT_VERSIONS[kind])
+            self.memory.set(key, variants)
+        return variants
+
+    async def _save(self, event_id: str, kind: str, content: str, tokens: int):
+        # список берётся до записи, иначе только что прочитанный из базы вариант добавился бы второй раз
+        variants = await self.variants(event_id, kind)
+        async with async_session() as session:
+            await db_add_ai_suggestion(session, event_id, kind, PROMPT_VERSIONS[kind], content, tokens)
+        variants.append(content)
+
+    # генерирует и сохраняет вариант; пока она идёт, другие ждут её через _in_flight.
+    # Проверка и регистрация идут без await между ними; если генерация по этому ключу уже идёт, возвращает None
+    async def _generate(self, event_id: str, kind: str, generate) -> tuple[str | None, int] | None:
+        key = (event_id, kind)
+        if key in self._in_flight:
+            return None
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        try:
+            gigachat_answer, tokens = await generate()
+            if gigachat_answer is not None:
+                await self._save(event_id, kind, gigachat_answer, tokens)
+            return gigachat_answer, tokens
+        finally:
+            if self._in_flight.get(key) is future:
+                del self._in_flight[key]
+            future.set_result(None)
+
+    # index-й вариант подсказки: готовый отдаётся сразу, а в фоне готовится следующий;
+    # если готового нет, организатор ждёт генерацию и видит её ход через on_progress; None - GigaChat не справился.
+    # Когда вариантов уже max_variants, новые не генерируются, а варианты показываются по кругу
+    async def get(self, event: Event, kind: str, index: int,
+                  on_progress: Callable[[str], None] | None = None) -> str | None:
+        while True:
+            variants = await self.variants(event.id, kind)
+            if index < len(variants):
+                if index + 1 >= len(variants):
+                    self.enqueue(event.id, kind, PRIORITY_NEXT_VARIANT, wanted=index + 2)
+                return variants[index]
+            if len(variants) >= self.max_variants:
+                return variants[index % len(variants)]
+            in_flight = self._in_flight.get((event.id, kind))
+            if in_flight is None:
+                generated = await self._generate(event.id, kind, lambda: generate_suggestion(
+                    kind, event.title, event.description, on_progress=on_progress))
+                if generated is not None:
+                    break
+            else:
+                # вариант уже генерируется (например, в фоне) - ждём его, а не платим за второй
+                await asyncio.shield(in_flight)
+
+        gigachat_answer, _ = generated
+        if gigachat_answer is not None:
+            self.enqueue(event.id, kind, PRIORITY_NEXT_VARIANT, wanted=len(variants) + 1)
+        return gigachat_answer
+
+    # запись, которая уже стоит в очереди, не дублируется, но организатор, который ждёт,
+    # поднимает её приоритет: в очередь кладётся новая запись, а старая при извлечении пропускается
+    def enqueue(self, event_id: str, kind: str, priority: int, wanted: int = 1):
+        if wanted > self.max_variants:
+            return
+        key = (event_id, kind)
+        queued = self._queued.get(key)
+        if queued is not None and queued[0] <= priority:
+            self._queued[key] = (queued[0], max(queued[1], wanted))
+            return
+        self._queued[key] = (priority, max(queued[1], wanted) if queued is not None else wanted)
+        self._queue.put_nowait((priority, next(self._order), event_id, kind))
+
+    # после перезапуска все анонсы сайта выглядят новыми - на них бюджет не тратим, они сгенерируются по запросу
+    async def on_catalog_diff(self, diff: CatalogDiff):
+        if diff.cold:
+            return
+        for rough_event in diff.new:
+            for kind in GENERATORS:
+                self.enqueue(rough_event.id, kind, PRIORITY_PREGENERATION)
+
+    def _spent_tokens(self) -> int:
+        while self._spent and time.monotonic() - self._spent[0][0] > self.budget_window:
+            self._spent.popleft()
+        return sum(tokens for _, tokens in self._spent)
+
+    async def _pregenerate(self, event_id: str, kind: str, wanted: int):
+        if len(await self.variants(event_id, kind)) >= wanted:
+            return
+        # для мероприятий, по которым игра уже создана, подсказки больше не нужны
+        async with async_session() as session:
+            if event_id in await db_get_event_game_ids(session):
+                return
+        if self._spent_tokens() >= self.token_budget:
+            logging.info(f"Бюджет токенов на фоновую генерацию исчерпан, пропускаем {kind} для {event_id}")
+            return
+        if (event_id, kind) in self._in_flight:
+            return
+        event = await event_details.get(event_id)
+        # здесь никто не ждёт, поэтому запросы по одному: лишние варианты стоят токенов;
+        # если, пока загружалось мероприятие, генерацию начал организатор, _generate вернёт None
+        generated = await self._generate(event_id, kind, lambda: generate_suggestion(
+            kind, event.title, event.description, candidates=1, rounds=3))
+        if generated is not None:
+            self._spent.append((time.monotonic(), generated[1]))
+
+    async def _worker(self):
+        while True:
+            priority, _, event_id, kind = await self._queue.get()
+            queued = self._queued.get((event_id, kind))
+            # запись вытеснена такой же с более высоким приоритетом или уже обработана
+            if queued is None or queued[0] != priority:
+                continue
+            # снимается до генерации: запрос, пришедший во время неё, встанет в очередь заново
+            del self._queued[(event_id, kind)]
+            try:
+                await self._pregenerate(event_id, kind, queued[1])
+            except Exception:
+                logging.exception(f"Не удалось заранее сгенерировать {kind} для {event_id}")
+
+    def start(self):
+        self._task = asyncio.create_task(self._worker())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+
+ai_suggestions = AISuggestions(token_budget=ai_pregeneration_token_budget,
+                               budget_window=ai_pregeneration_budget_window,
+                               max_variants=ai_suggestion_max_variants, cache_size=ai_suggestion_cache_size)
+catalog.subscribe(ai_suggestions.on_catalog_diff)
+register_cache("ai_suggestions", ai_suggestions.memory)
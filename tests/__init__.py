@@ -0,0 +1,36 @@
+import atexit
+import datetime
+import os
+import shutil
+import tempfile
+
+# до импорта db: тесты работают с временной базой, а не с db.db бота
+_directory = tempfile.mkdtemp(prefix="bot-tests-")
+atexit.register(shutil.rmtree, _directory, ignore_errors=True)
+os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{os.path.join(_directory, 'test.db')}"
+os.environ.setdefault("TG_TOKEN", "1:test")
+os.environ.setdefault("GIGACHAT_TOKEN", "test")
+
+
+# пустые таблицы перед каждым тестом
+async def reset_database():
+    from db import Base, create_tables, engine
+
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+    await create_tables()
+
+
+# мероприятие с сайта в том виде, в каком его отдаёт парсер: из .ics время приходит в UTC с поясом
+def make_event(event_id: str = "900100000"):
+    from classes import Event
+
+    event = Event()
+    event.id = event_id
+    event.title = "Лекция"
+    event.rating = "5"
+    event.description = "Описание"
+    event.address = "Покровский бульвар, 11"
+    event.start = datetime.datetime(2099, 1, 17, 15, tzinfo=datetime.timezone.utc)
+    event.end = datetime.datetime(2099, 1, 17, 16, 30, tzinfo=datetime.timezone.utc)
+    return event
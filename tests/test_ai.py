@@ -0,0 +1,44 @@
+import asyncio
+import unittest
+from unittest import mock
+
+import ai
+
+VALID_STOPS = "1. a\n2. b\n3. c\n4. d\n5. e"
+
+
+# вместо GigaChat: i-й параллельный запрос возвращает или бросает outcomes[i]
+def fake_gigachat(outcomes: list):
+    calls = iter(range(len(outcomes)))
+
+    async def get_from_gigachat(title, description, on_chunk=None):
+        outcome = outcomes[next(calls)]
+        await asyncio.sleep(0.01)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome, 10
+
+    return mock.patch.dict(ai.GENERATORS, {"stops": (get_from_gigachat, ai.normalize_stops)})
+
+
+class GenerateSuggestionTest(unittest.IsolatedAsyncioTestCase):
+    async def test_failed_candidate_does_not_cancel_others(self):
+        with fake_gigachat([ConnectionError("reset"), VALID_STOPS, VALID_STOPS]):
+            suggestion, _ = await ai.generate_suggestion("stops", "Лекция", "Описание", candidates=3)
+        self.assertEqual(suggestion, VALID_STOPS)
+
+    async def test_invalid_answers(self):
+        with fake_gigachat([ConnectionError("reset"), "не то", "тоже не то"]):
+            self.assertEqual(await ai.generate_suggestion("stops", "Лекция", "Описание", candidates=3), (None, 20))
+
+    async def test_all_candidates_failed(self):
+        with fake_gigachat([ConnectionError("reset"), ConnectionError("reset")]):
+            with self.assertRaises(ConnectionError):
+                await ai.generate_suggestion("stops", "Лекция", "Описание", candidates=2)
+        with fake_gigachat([TimeoutError(), TimeoutError()]):
+            with self.assertRaises(TimeoutError):
+                await ai.generate_suggestion("stops", "Лекция", "Описание", candidates=2)
+
+
+if __name__ == "__main__":
+    unittest.main()
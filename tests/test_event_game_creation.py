@@ -0,0 +1,55 @@
+import datetime
+import unittest
+
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+
+from db import async_session, db_add_event_game, DBEventGame
+from game_content import new_event_game
+from misc import moscow_tz
+from notifications import NotificationScheduler, notification_time
+from tests import make_event, reset_database
+
+
+# то, что делает create_event_game_questions_handler: запись игры и планирование уведомлений по тому же объекту
+class EventGameCreationTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        await reset_database()
+        self.scheduler = AsyncIOScheduler(timezone="Europe/Moscow")
+        self.scheduler.start(paused=True)
+
+    async def asyncTearDown(self):
+        self.scheduler.shutdown(wait=False)
+
+    def run_dates(self) -> dict[str, datetime.datetime]:
+        return {job.id.rsplit(":", 1)[1]: job.trigger.run_date for job in self.scheduler.get_jobs()}
+
+    async def test_schedule_after_create(self):
+        db_event_game = new_event_game(make_event(), ["Точка"], [["Вопрос", "Да", "Нет", "Не знаю"]])
+        self.assertEqual(db_event_game.start, datetime.datetime(2099, 1, 17, 18))
+        async with async_session() as session:
+            await db_add_event_game(session, db_event_game)
+        NotificationScheduler(self.scheduler, outbox=None).schedule_event_game(db_event_game)
+
+        expected = {"pre_start": moscow_tz.localize(datetime.datetime(2099, 1, 17, 17)),
+                    "start": moscow_tz.localize(datetime.datetime(2099, 1, 17, 18)),
+                    "end": moscow_tz.localize(datetime.datetime(2099, 1, 17, 19, 30))}
+        self.assertEqual(self.run_dates(), expected)
+
+        # после перезапуска игра читается из базы, и время должно быть тем же
+        async with async_session() as session:
+            db_event_game = await session.get(DBEventGame, "900100000")
+        NotificationScheduler(self.scheduler, outbox=None).schedule_event_game(db_event_game)
+        self.assertEqual(self.run_dates(), expected)
+
+    def test_notification_time_accepts_aware(self):
+        db_event_game = DBEventGame()
+        db_event_game.start = datetime.datetime(2099, 1, 17, 15, tzinfo=datetime.timezone.utc)
+        db_event_game.end = datetime.datetime(2099, 1, 17, 18)
+        self.assertEqual(notification_time(db_event_game, "start"),
+                         moscow_tz.localize(datetime.datetime(2099, 1, 17, 18)))
+        self.assertEqual(notification_time(db_event_game, "end"),
+                         moscow_tz.localize(datetime.datetime(2099, 1, 17, 18)))
+
+
+if __name__ == "__main__":
+    unittest.main()
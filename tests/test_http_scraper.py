@@ -0,0 +1,103 @@
+import datetime
+import hashlib
+import os
+import unittest
+
+from aiohttp import web
+
+from http_scraper import HttpEngine, parse_event, parse_rough_events
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), os.pardir, "benchmarks", "fixtures")
+EVENT_ID = "900100000"
+
+
+def read_fixture(name: str) -> bytes:
+    with open(os.path.join(FIXTURES_DIR, name), "rb") as fixture:
+        return fixture.read()
+
+
+class ParseFixturesTest(unittest.TestCase):
+    def test_rough_events(self):
+        rough_events = parse_rough_events(read_fixture("announcements.html").decode())
+        self.assertEqual(len(rough_events), 10)
+        self.assertEqual([rough_event.id for rough_event in rough_events[:3]],
+                         ["900100000", "900100001", "900100002"])
+        self.assertEqual(rough_events[0].title, "Лекция «Искусственный интеллект в медицине»")
+        self.assertEqual(rough_events[1].title, "Мастер-класс по публичным выступлениям")
+        # "1–2 января" - берётся первый день, год текущий
+        year = datetime.date.today().year
+        self.assertEqual(rough_events[0].date, datetime.datetime(year, 1, 1))
+        self.assertEqual(rough_events[1].date, datetime.datetime(year, 1, 2))
+
+    def test_event(self):
+        event = parse_event(EVENT_ID, read_fixture("event.html").decode(), read_fixture("event.ics"))
+        self.assertEqual(event.id, EVENT_ID)
+        self.assertEqual(event.title, "Лекция «Искусственный интеллект в медицине»")
+        self.assertEqual(event.rating, "12+")
+        self.assertEqual(event.address, "Покровский бульвар, 11, ауд. R208")
+        self.assertEqual(event.start, datetime.datetime(2025, 1, 17, 15, tzinfo=datetime.timezone.utc))
+        self.assertEqual(event.end, datetime.datetime(2025, 1, 17, 16, 30, tzinfo=datetime.timezone.utc))
+        self.assertTrue(event.description.startswith("Приглашаем на лекцию"))
+        self.assertIn("разбор реальных кейсов;", event.description)
+        self.assertNotIn("Добавить в календарь", event.description)
+
+
+# HttpEngine против локального сервера с записанными страницами, который понимает If-None-Match
+class HttpEngineTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.requests: list[str] = []
+
+        async def respond(request: web.Request, name: str) -> web.Response:
+            self.requests.append(request.path)
+            body = read_fixture(name)
+            etag = f'"{hashlib.md5(body).hexdigest()}"'
+            if request.headers.get("If-None-Match") == etag:
+                return web.Response(status=304, headers={"ETag": etag})
+            return web.Response(body=body, headers={"ETag": etag, "Content-Type": "text/html; charset=utf-8"})
+
+        def fixture(name: str):
+            async def handler(request: web.Request) -> web.Response:
+                return await respond(request, name)
+            return handler
+
+        async def announcements_page(request: web.Request) -> web.Response:
+            name = f"announcements_page{request.match_info['page']}.html"
+            if not os.path.exists(os.path.join(FIXTURES_DIR, name)):
+                raise web.HTTPNotFound()
+            return await respond(request, name)
+
+        app = web.Application()
+        app.router.add_get("/news/announcements/", fixture("announcements.html"))
+        app.router.add_get(r"/news/announcements/page{page:\d+}.html", announcements_page)
+        app.router.add_get(r"/announcements/{event_id:\d+}.html", fixture("event.html"))
+        app.router.add_get(r"/events/ics/{event_id:\d+}.ics", fixture("event.ics"))
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        self.engine = HttpEngine(base_url=f"http://127.0.0.1:{self.runner.addresses[0][1]}", timeout=10)
+
+    async def asyncTearDown(self):
+        await self.engine.close()
+        await self.runner.cleanup()
+
+    async def test_rough_events_pages(self):
+        self.assertEqual((await self.engine.get_rough_events(1))[0].id, "900100000")
+        self.assertEqual((await self.engine.get_rough_events(2))[0].id, "900100010")
+        # за последней страницей сайт отвечает 404
+        self.assertEqual(await self.engine.get_rough_events(3), [])
+
+    async def test_event_not_modified(self):
+        event = await self.engine.get_event(EVENT_ID)
+        self.assertEqual(event.title, "Лекция «Искусственный интеллект в медицине»")
+        self.assertEqual(event.etag, f'"{hashlib.md5(read_fixture("event.html")).hexdigest()}"')
+        self.assertCountEqual(self.requests, [f"/announcements/{EVENT_ID}.html", f"/events/ics/{EVENT_ID}.ics"])
+
+        # страница не изменилась: 304 и тот же объект, .ics не запрашивается
+        self.requests.clear()
+        self.assertIs(await self.engine.get_event(EVENT_ID, cached=event), event)
+        self.assertEqual(self.requests, [f"/announcements/{EVENT_ID}.html"])
+
+
+if __name__ == "__main__":
+    unittest.main()
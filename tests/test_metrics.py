@@ -0,0 +1,30 @@
+import unittest
+
+from metrics import register_cache, render_metrics
+from misc import LRUCache
+
+
+class CacheMetricsTest(unittest.TestCase):
+    def test_cache_counters(self):
+        cache = LRUCache(maxsize=10)
+        register_cache("test", cache)
+        cache.set("a", 1)
+        cache.get("a")
+        cache.get("a")
+        cache.get("b")
+        lines = render_metrics().splitlines()
+        self.assertIn("# TYPE bot_cache_hits_total counter", lines)
+        self.assertIn('bot_cache_hits_total{cache="test"} 2', lines)
+        self.assertIn('bot_cache_misses_total{cache="test"} 1', lines)
+        self.assertIn('bot_cache_size{cache="test"} 1', lines)
+
+    def test_bot_caches_registered(self):
+        from db import user_cache
+
+        lines = render_metrics().splitlines()
+        self.assertIn(f'bot_cache_hits_total{{cache="user"}} {user_cache.hits}', lines)
+        self.assertIn(f'bot_cache_misses_total{{cache="user"}} {user_cache.misses}', lines)
+
+
+if __name__ == "__main__":
+    unittest.main()
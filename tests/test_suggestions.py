@@ -0,0 +1,126 @@
+import asyncio
+import datetime
+import unittest
+from unittest import mock
+
+from catalog import merge_rough_events
+from classes import RoughEvent
+from db import async_session, db_get_ai_suggestions
+from suggestions import AISuggestions, PRIORITY_NEXT_VARIANT, PRIORITY_PREGENERATION
+from tests import make_event, reset_database
+
+EVENT_ID = "900100000"
+
+
+# вместо GigaChat: варианты "вариант 1", "вариант 2", ...; release задерживает ответ
+class FakeGenerator:
+    def __init__(self):
+        self.calls = 0
+        self.release = asyncio.Event()
+        self.release.set()
+
+    async def __call__(self, kind, title, description, **kwargs):
+        self.calls += 1
+        number = self.calls
+        await self.release.wait()
+        return f"вариант {number}", 10
+
+
+class AISuggestionsTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        await reset_database()
+        self.generator = FakeGenerator()
+        patcher = mock.patch("suggestions.generate_suggestion", self.generator)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch("suggestions.event_details.get", mock.AsyncMock(side_effect=make_event))
+        self.suggestions_event_get = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.suggestions = AISuggestions(token_budget=1000, budget_window=3600, max_variants=2, cache_size=16)
+
+    async def asyncTearDown(self):
+        await self.suggestions.stop()
+
+    async def test_variants_cycle_after_max(self):
+        answers = [await self.suggestions.get(make_event(), "stops", index) for index in range(5)]
+        self.assertEqual(answers, ["вариант 1", "вариант 2", "вариант 1", "вариант 2", "вариант 1"])
+        self.assertEqual(self.generator.calls, 2)
+        async with async_session() as session:
+            self.assertEqual(len(await db_get_ai_suggestions(session, EVENT_ID, "stops", 1)), 2)
+
+    async def test_waiting_organizer_raises_priority(self):
+        processed = []
+
+        async def pregenerate(event_id, kind, wanted):
+            processed.append((event_id, kind, wanted))
+
+        self.suggestions._pregenerate = pregenerate
+        self.suggestions.enqueue("1", "stops", PRIORITY_PREGENERATION)
+        self.suggestions.enqueue("2", "stops", PRIORITY_PREGENERATION)
+        self.suggestions.enqueue("2", "stops", PRIORITY_NEXT_VARIANT, wanted=2)
+        self.suggestions.start()
+        while self.suggestions._queue.qsize():
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.01)
+        # запись для "2" поднялась вперёд и не обработалась второй раз
+        self.assertEqual(processed, [("2", "stops", 2), ("1", "stops", 1)])
+
+    async def test_interactive_waits_for_background_generation(self):
+        self.generator.release.clear()
+        pregeneration = asyncio.create_task(self.suggestions._pregenerate(EVENT_ID, "stops", wanted=1))
+        while not self.generator.calls:
+            await asyncio.sleep(0.01)
+        interactive = asyncio.create_task(self.suggestions.get(make_event(), "stops", 0))
+        await asyncio.sleep(0.01)
+        self.generator.release.set()
+        await pregeneration
+        self.assertEqual(await interactive, "вариант 1")
+        self.assertEqual(self.generator.calls, 1)
+        self.assertEqual(await self.suggestions.variants(EVENT_ID, "stops"), ["вариант 1"])
+
+    async def test_organizer_starts_while_background_loads_event(self):
+        # фоновая задача уже прошла проверку _in_flight и ждёт подробностей мероприятия
+        loaded = asyncio.Event()
+
+        async def slow_event(event_id):
+            await loaded.wait()
+            return make_event(event_id)
+
+        self.suggestions_event_get.side_effect = slow_event
+        pregeneration = asyncio.create_task(self.suggestions._pregenerate(EVENT_ID, "stops", wanted=1))
+        await asyncio.sleep(0.01)
+        self.generator.release.clear()
+        interactive = asyncio.create_task(self.suggestions.get(make_event(), "stops", 0))
+        while not self.generator.calls:
+            await asyncio.sleep(0.01)
+        loaded.set()
+        # wait_for: при гонке фоновая задача платила бы за второй вызов, а организатор ждал бы вечно
+        self.generator.release.set()
+        await asyncio.wait_for(pregeneration, 1)
+        self.assertEqual(await asyncio.wait_for(interactive, 1), "вариант 1")
+        self.assertEqual(self.generator.calls, 1)
+        self.assertEqual(self.suggestions._in_flight, {})
+        # следующий вариант генерируется, а не ждёт чужую генерацию
+        self.assertEqual(await asyncio.wait_for(self.suggestions.get(make_event(), "stops", 1), 1), "вариант 2")
+
+    async def test_cold_catalog_is_not_pregenerated(self):
+        def rough_event(event_id):
+            rough = RoughEvent()
+            rough.id = event_id
+            rough.title = "Лекция"
+            rough.date = datetime.datetime(2099, 1, 1)
+            return rough
+
+        enqueued = []
+        self.suggestions.enqueue = lambda event_id, kind, priority, wanted=1: enqueued.append((event_id, kind))
+        # первое обновление после запуска: весь сайт "новый", но это не новые анонсы
+        known, diff = merge_rough_events([], [rough_event("1"), rough_event("2")], crawl_complete=True)
+        await self.suggestions.on_catalog_diff(diff)
+        self.assertEqual(enqueued, [])
+        _, diff = merge_rough_events(known, [rough_event("3")] + known, crawl_complete=True)
+        await self.suggestions.on_catalog_diff(diff)
+        self.assertEqual(enqueued, [("3", "stops"), ("3", "questions")])
+
+
+if __name__ == "__main__":
+    unittest.main()
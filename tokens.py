@@ -5,4 +5,92 @@ from dotenv import load_dotenv
 load_dotenv()
 
 tg_token = os.getenv('TG_TOKEN')
-gigachat_token = os.getenv("GIGACHAT_TOKEN")
\ No newline at end of file
+gigachat_token = os.getenv("GIGACHAT_TOKEN")
+# база бота; тесты подменяют её на временный файл
+database_url = os.getenv("DATABASE_URL", "sqlite+aiosqlite:///db.db")
+# GigaChat: сколько запросов к модели можно делать одновременно, сколько секунд ждать один ответ
+# и сколько вариантов запрашивать параллельно, когда организатор ждёт
+gigachat_concurrency = int(os.getenv("GIGACHAT_CONCURRENCY", 4))
+gigachat_timeout = float(os.getenv("GIGACHAT_TIMEOUT", 60))
+gigachat_candidates = int(os.getenv("GIGACHAT_CANDIDATES", 3))
+# как часто (в секундах) можно править сообщение с ответом GigaChat, пока он пишется: Telegram ограничивает частоту правок
+gigachat_stream_edit_interval = float(os.getenv("GIGACHAT_STREAM_EDIT_INTERVAL", 1.5))
+# подсказки GigaChat: сколько вариантов на мероприятие держать наготове, сколько мероприятий держать в памяти
+# и сколько токенов за окно в секундах можно потратить на фоновую генерацию
+ai_suggestion_max_variants = int(os.getenv("AI_SUGGESTION_MAX_VARIANTS", 3))
+ai_suggestion_cache_size = int(os.getenv("AI_SUGGESTION_CACHE_SIZE", 256))
+ai_pregeneration_token_budget = int(os.getenv("AI_PREGENERATION_TOKEN_BUDGET", 100000))
+ai_pregeneration_budget_window = int(os.getenv("AI_PREGENERATION_BUDGET_WINDOW", 24 * 3600))
+
+# каталог анонсов: как часто обновлять, сколько считать свежим и сколько ещё можно отдавать устаревшим (в секундах)
+catalog_refresh_interval = int(os.getenv("CATALOG_REFRESH_INTERVAL", 300))
+catalog_ttl = int(os.getenv("CATALOG_TTL", 600))
+catalog_max_stale = int(os.getenv("CATALOG_MAX_STALE", 3600))
+
+# чем получать страницы EXTRA.HSE: "http" (aiohttp + парсер HTML) или "selenium"; Selenium остаётся запасным вариантом
+scraper_engine = os.getenv("SCRAPER_ENGINE", "http")
+scraper_fallback = os.getenv("SCRAPER_FALLBACK", "1") == "1"
+scraper_timeout = float(os.getenv("SCRAPER_TIMEOUT", 15))
+extra_hse_url = os.getenv("EXTRA_HSE_URL", "https://extra.hse.ru")
+
+# пул браузеров Selenium: сколько Chrome держать, сколько секунд можно держать один и сколько запросов ждут в очереди
+driver_pool_size = int(os.getenv("DRIVER_POOL_SIZE", min(os.cpu_count() or 1, 4)))
+driver_lease_timeout = float(os.getenv("DRIVER_LEASE_TIMEOUT", 60))
+driver_pool_max_waiters = int(os.getenv("DRIVER_POOL_MAX_WAITERS", 32))
+
+# подробности мероприятия: сколько секунд считать их свежими без запроса к сайту и сколько держать в памяти
+event_details_max_age = int(os.getenv("EVENT_DETAILS_MAX_AGE", 3600))
+event_details_cache_size = int(os.getenv("EVENT_DETAILS_CACHE_SIZE", 256))
+catalog_max_pages = int(os.getenv("CATALOG_MAX_PAGES", 20))
+
+# рассылки: общий лимит сообщений в секунду (у Telegram ~30), число одновременных отправок и пауза между сообщениями в один чат
+broadcast_rate = float(os.getenv("BROADCAST_RATE", 25))
+broadcast_workers = int(os.getenv("BROADCAST_WORKERS", 16))
+broadcast_chat_interval = float(os.getenv("BROADCAST_CHAT_INTERVAL", 1))
+
+# очередь уведомлений: число воркеров, сколько сообщений забирать за раз, на сколько секунд их бронировать,
+# сколько раз пытаться доставить и как часто проверять очередь без явного сигнала
+outbox_workers = int(os.getenv("OUTBOX_WORKERS", 2))
+outbox_batch_size = int(os.getenv("OUTBOX_BATCH_SIZE", 50))
+outbox_lease = int(os.getenv("OUTBOX_LEASE", 120))
+outbox_max_attempts = int(os.getenv("OUTBOX_MAX_ATTEMPTS", 5))
+outbox_poll_interval = float(os.getenv("OUTBOX_POLL_INTERVAL", 5))
+
+# кэш профилей пользователей: сколько держать в памяти и сколько секунд
+user_cache_size = int(os.getenv("USER_CACHE_SIZE", 10000))
+user_cache_ttl = int(os.getenv("USER_CACHE_TTL", 300))
+
+# состояния FSM (создание игры, регистрация): через сколько секунд без изменений считать их брошенными,
+# сколько держать в памяти и как часто (в секундах) чистить таблицу
+fsm_ttl = int(os.getenv("FSM_TTL", 2 * 24 * 3600))
+fsm_cache_size = int(os.getenv("FSM_CACHE_SIZE", 10000))
+fsm_purge_interval = int(os.getenv("FSM_PURGE_INTERVAL", 3600))
+
+# сколько игр держать в памяти уже разобранными (точки и вопросы)
+event_game_content_cache_size = int(os.getenv("EVENT_GAME_CONTENT_CACHE_SIZE", 512))
+
+# журнал апдейтов: куда писать, сколько строк держать в очереди, сколько писать за раз и не реже раза в сколько секунд,
+# при каком размере файла (в байтах, 0 - никогда) начинать новый и сжимать ли старые в gzip
+update_log_dir = os.getenv("UPDATE_LOG_DIR", ".")
+update_log_queue_size = int(os.getenv("UPDATE_LOG_QUEUE_SIZE", 10000))
+update_log_batch_size = int(os.getenv("UPDATE_LOG_BATCH_SIZE", 500))
+update_log_flush_interval = float(os.getenv("UPDATE_LOG_FLUSH_INTERVAL", 1))
+update_log_max_bytes = int(os.getenv("UPDATE_LOG_MAX_BYTES", 50 * 1024 * 1024))
+update_log_compress = os.getenv("UPDATE_LOG_COMPRESS", "1") == "1"
+
+# метрики в формате Prometheus и профайлер: адрес и порт HTTP-сервера (0 - не запускать)
+metrics_host = os.getenv("METRICS_HOST", "127.0.0.1")
+metrics_port = int(os.getenv("METRICS_PORT", 0))
+
+# как получать апдейты: "polling" или "webhook"; для webhook - публичный адрес, который регистрируется у Telegram,
+# где слушать, секрет для заголовка X-Telegram-Bot-Api-Secret-Token, число обработчиков и размер очереди апдейтов
+bot_mode = os.getenv("BOT_MODE", "polling")
+webhook_url = os.getenv("WEBHOOK_URL")
+webhook_host = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+webhook_port = int(os.getenv("WEBHOOK_PORT", 8080))
+webhook_path = os.getenv("WEBHOOK_PATH", "/webhook")
+webhook_secret = os.getenv("WEBHOOK_SECRET")
+webhook_workers = int(os.getenv("WEBHOOK_WORKERS", 8))
+webhook_queue_size = int(os.getenv("WEBHOOK_QUEUE_SIZE", 1000))
+# адрес Bot API, например локального сервера или заглушки для нагрузочных проверок; по умолчанию - api.telegram.org
+telegram_api_url = os.getenv("TELEGRAM_API_URL")
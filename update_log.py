@@ -0,0 +1,122 @@
+import asyncio
+import csv
+import datetime
+import gzip
+import io
+import logging
+import os
+import shutil
+
+from aiogram.types import Update
+
+HEADER = "update_id,user_id,datetime,event_type,data\n"
+
+
+# строка журнала для апдейта: (update_id, user_id, datetime, event_type, data)
+def update_log_record(update: Update, user_id: int) -> tuple:
+    if update.message:
+        # у фото, стикеров и т.п. текста нет
+        message = update.message
+        return (update.update_id, user_id, datetime.datetime.now(), "message",
+                message.text if message.text is not None else message.caption or f"<{message.content_type.value}>")
+    if update.callback_query:
+        return update.update_id, user_id, datetime.datetime.now(), "callback_query", update.callback_query.data
+    return update.update_id, user_id, datetime.datetime.now(), "unknown", None
+
+
+# журнал апдейтов в CSV: запись только кладёт строку в очередь, а файл пишет фоновая задача пачками
+# в отдельном потоке; если очередь переполнена, строка теряется, но обработка апдейта не ждёт диск
+class UpdateLogSink:
+    def __init__(self, directory: str, max_queue: int, batch_size: int, flush_interval: float, max_bytes: int,
+                 compress: bool):
+        self.directory = directory
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.compress = compress
+        self.dropped = 0
+        self._queue: asyncio.Queue[tuple] = asyncio.Queue(maxsize=max_queue)
+        self._task: asyncio.Task | None = None
+        # строки, уже взятые из очереди, и идущая запись: при остановке их нельзя потерять
+        self._pending: list[tuple] = []
+        self._flush_task: asyncio.Task | None = None
+        self._file_name = self._new_file_name()
+
+    def _new_file_name(self) -> str:
+        return os.path.join(self.directory, f"log-{datetime.datetime.now()}.csv")
+
+    def write(self, record: tuple):
+        try:
+            self._queue.put_nowait(record)
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    # пачка закрывается, когда набралось batch_size строк или прошло flush_interval секунд с первой
+    async def _fill_batch(self):
+        self._pending.append(await self._queue.get())
+        deadline = asyncio.get_running_loop().time() + self.flush_interval
+        while len(self._pending) < self.batch_size:
+            timeout = deadline - asyncio.get_running_loop().time()
+            if timeout <= 0:
+                break
+            try:
+                self._pending.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except TimeoutError:
+                break
+
+    @staticmethod
+    def _format(batch: list[tuple]) -> str:
+        buffer = io.StringIO()
+        csv.writer(buffer, lineterminator="\n").writerows(batch)
+        return buffer.getvalue()
+
+    # выполняется в потоке
+    def _write_to_file(self, text: str):
+        with open(self._file_name, "a", encoding="utf-8", newline="") as csv_file:
+            # у каждого файла, в том числе после ротации, свой заголовок
+            if csv_file.tell() == 0:
+                csv_file.write(HEADER)
+            csv_file.write(text)
+            size = csv_file.tell()
+        if self.max_bytes and size >= self.max_bytes:
+            self._rotate()
+
+    def _rotate(self):
+        full_file_name, self._file_name = self._file_name, self._new_file_name()
+        if self.compress:
+            with open(full_file_name, "rb") as source, gzip.open(f"{full_file_name}.gz", "wb") as target:
+                shutil.copyfileobj(source, target)
+            os.remove(full_file_name)
+
+    async def _flush(self, batch: list[tuple]):
+        try:
+            await asyncio.to_thread(self._write_to_file, self._format(batch))
+        except Exception:
+            logging.exception(f"Не удалось записать {len(batch)} строк журнала апдейтов")
+
+    async def _writer(self):
+        while True:
+            await self._fill_batch()
+            batch, self._pending = self._pending, []
+            self._flush_task = asyncio.create_task(self._flush(batch))
+            await asyncio.shield(self._flush_task)
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._task = asyncio.create_task(self._writer())
+
+    # дописывает всё, что осталось в очереди
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._flush_task is not None:
+            await self._flush_task
+        batch, self._pending = self._pending, []
+        while not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+        if batch:
+            await self._flush(batch)
+        if self.dropped:
+            logging.warning(f"Журнал апдейтов: из-за переполнения очереди потеряно {self.dropped} строк")
@@ -0,0 +1,91 @@
+import asyncio
+import hmac
+import logging
+import signal
+from contextlib import suppress
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+from aiohttp import web
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+# приём апдейтов через webhook: обработчик HTTP только кладёт апдейт в ограниченную очередь и сразу отвечает 200,
+# а обрабатывают апдейты workers задач; если очередь полна, Telegram получает 503 и повторит доставку позже
+class WebhookServer:
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, workers: int, queue_size: int, secret: str | None = None):
+        self.dispatcher = dispatcher
+        self.bot = bot
+        self.workers = workers
+        self.secret = secret
+        self.rejected = 0
+        self._queue: asyncio.Queue[Update] = asyncio.Queue(maxsize=queue_size)
+        self._tasks: list[asyncio.Task] = []
+        self._runner: web.AppRunner | None = None
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if self.secret and not hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), self.secret):
+            return web.Response(status=401)
+        try:
+            update = Update.model_validate(await request.json(), context={"bot": self.bot})
+        except ValueError:
+            return web.Response(status=400)
+        try:
+            self._queue.put_nowait(update)
+        except asyncio.QueueFull:
+            self.rejected += 1
+            return web.Response(status=503)
+        return web.Response()
+
+    async def _worker(self):
+        while True:
+            update = await self._queue.get()
+            try:
+                await self.dispatcher.feed_update(self.bot, update)
+            except Exception:
+                logging.exception(f"Не удалось обработать апдейт {update.update_id}")
+            finally:
+                self._queue.task_done()
+
+    async def start(self, host: str, port: int, path: str):
+        app = web.Application()
+        app.router.add_post(path, self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        await web.TCPSite(self._runner, host, port).start()
+        logging.info(f"Webhook слушает http://{host}:{port}{path}")
+
+    # сначала перестаёт принимать апдейты, потом дорабатывает то, что уже в очереди
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+        await self._queue.join()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self.rejected:
+            logging.warning(f"Webhook: из-за переполнения очереди отклонено {self.rejected} апдейтов")
+
+
+# то же, что dp.start_polling, но через webhook: регистрирует url у Telegram и работает до SIGINT/SIGTERM
+async def run_webhook(dispatcher: Dispatcher, bot: Bot, url: str, host: str, port: int, path: str, workers: int,
+                      queue_size: int, secret: str | None = None):
+    server = WebhookServer(dispatcher, bot, workers=workers, queue_size=queue_size, secret=secret)
+    stop_signal = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    with suppress(NotImplementedError):
+        loop.add_signal_handler(signal.SIGTERM, stop_signal.set)
+        loop.add_signal_handler(signal.SIGINT, stop_signal.set)
+
+    await dispatcher.emit_startup(bot=bot, dispatcher=dispatcher, **dispatcher.workflow_data)
+    try:
+        await server.start(host, port, path)
+        await bot.set_webhook(url, secret_token=secret, allowed_updates=dispatcher.resolve_used_update_types())
+        await stop_signal.wait()
+    finally:
+        await server.stop()
+        await dispatcher.emit_shutdown(bot=bot, dispatcher=dispatcher, **dispatcher.workflow_data)